@@ -123,7 +123,6 @@ import sys
 import os
 import argparse
 import re
-from time import time
 import boto
 from boto import ec2
 from boto import rds
@@ -139,6 +138,12 @@ try:
 except ImportError:
     import simplejson as json
 
+# CloudInventoryCache is shared by the inventory scripts of this repository,
+# from its inventory/lib directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', '..', 'inventory', 'lib'))
+from cloud_inventory_cache import CloudInventoryCache
+
 
 class Ec2Inventory(object):
     def _empty_inventory(self):
@@ -190,14 +195,7 @@ class Ec2Inventory(object):
     def is_cache_valid(self):
         ''' Determines if the cache files have expired, or if it is still valid '''
 
-        if os.path.isfile(self.cache_path_cache):
-            mod_time = os.path.getmtime(self.cache_path_cache)
-            current_time = time()
-            if (mod_time + self.cache_max_age) > current_time:
-                if os.path.isfile(self.cache_path_index):
-                    return True
-
-        return False
+        return self.cache.is_valid() and os.path.isfile(self.cache_path_index)
 
 
     def read_settings(self):
@@ -325,9 +323,21 @@ class Ec2Inventory(object):
         if not os.path.exists(cache_dir):
             os.makedirs(cache_dir)
 
-        self.cache_path_cache = cache_dir + "/ansible-ec2.cache"
-        self.cache_path_index = cache_dir + "/ansible-ec2.index"
+        cache_name = 'ansible-ec2'
         self.cache_max_age = config.getint('ec2', 'cache_max_age')
+        cache_compression = ''
+        if config.has_option('ec2', 'cache_compression'):
+            cache_compression = config.get('ec2', 'cache_compression')
+        self.cache = CloudInventoryCache(cache_name='%s.cache' % cache_name,
+                                         cache_path=cache_dir,
+                                         cache_max_age=self.cache_max_age,
+                                         compression=cache_compression)
+        self.index_cache = CloudInventoryCache(cache_name='%s.index' % cache_name,
+                                               cache_path=cache_dir,
+                                               cache_max_age=self.cache_max_age,
+                                               compression=cache_compression)
+        self.cache_path_cache = self.cache.cache_path_cache
+        self.cache_path_index = self.index_cache.cache_path_cache
 
         # Configure nested groups instead of flat namespace.
         if config.has_option('ec2', 'nested_groups'):
@@ -428,8 +438,8 @@ class Ec2Inventory(object):
                 self.get_elasticache_clusters_by_region(region)
                 self.get_elasticache_replication_groups_by_region(region)
 
-        self.write_to_cache(self.inventory, self.cache_path_cache)
-        self.write_to_cache(self.index, self.cache_path_index)
+        self.cache.write_to_cache(self.inventory)
+        self.index_cache.write_to_cache(self.index)
 
     def connect(self, region):
         ''' create connection to api server'''
@@ -1276,26 +1286,13 @@ class Ec2Inventory(object):
         ''' Reads the inventory from the cache file and returns it as a JSON
         object '''
 
-        cache = open(self.cache_path_cache, 'r')
-        json_inventory = cache.read()
-        return json_inventory
+        return self.cache.get_raw_data_from_cache()
 
 
     def load_index_from_cache(self):
         ''' Reads the index from the cache file sets self.index '''
 
-        cache = open(self.cache_path_index, 'r')
-        json_index = cache.read()
-        self.index = json.loads(json_index)
-
-
-    def write_to_cache(self, data, filename):
-        ''' Writes data in JSON format to a file '''
-
-        json_data = self.json_format_dict(data, True)
-        cache = open(filename, 'w')
-        cache.write(json_data)
-        cache.close()
+        self.index = self.index_cache.get_all_data_from_cache()
 
     def uncammelize(self, key):
         temp = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', key)
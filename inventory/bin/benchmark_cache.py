@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+# Measure plain and compressed inventory caches
+#
+# Writes a cache of 1000, 10000 and 50000 synthetic hosts (or the --hosts
+# given) with CloudInventoryCache, plain and with each compression the
+# interpreter supports, then prints the size of each cache file and the
+# median time of --runs loads of it. Use --cache-path to measure the
+# filesystem the inventory caches live on, e.g. a network mount.
+#
+
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'lib'))
+
+import cloud_inventory_cache
+from cloud_inventory_cache import CloudInventoryCache
+
+
+def make_inventory(count):
+    hostvars = {}
+    groups = {}
+    for i in range(count):
+        name = 'host-%05d' % i
+        zone = 'us-east-1%s' % 'abc'[i % 3]
+        hostvars[name] = {
+            'ec2_id': 'i-%017x' % i, 'ec2_placement': zone,
+            'ec2_instance_type': 'm4.xlarge', 'ec2_state': 'running',
+            'ec2_private_ip_address': '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+            'ec2_private_dns_name': 'ip-10-%d-%d-%d.ec2.internal' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+            'ec2_tag_Name': name, 'ec2_tag_openshift-role': ('master', 'infra', 'app')[i % 3],
+            'ec2_security_group_ids': 'sg-0123456789abcdef0',
+            'ec2_key_name': 'openshift', 'ansible_ssh_host': name}
+        for group in (zone, 'type_m4_xlarge', 'tag_openshift-role_%s' % ('master', 'infra', 'app')[i % 3]):
+            groups.setdefault(group, []).append(name)
+    groups['_meta'] = {'hostvars': hostvars}
+    return groups
+
+
+def measure(cache_path, count, compression, runs):
+    cache = CloudInventoryCache(cache_name='benchmark-%d.cache' % count,
+                                cache_path=cache_path, compression=compression)
+    cache.write_to_cache(make_inventory(count))
+    size = os.path.getsize(cache.cache_path_cache)
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        cache.get_all_data_from_cache()
+        times.append(time.time() - start)
+    os.remove(cache.cache_path_cache)
+    times.sort()
+    return size, times[len(times) // 2]
+
+
+if __name__ == "__main__":
+
+    def process_arguments():
+        parser = ArgumentParser()
+        parser.add_argument("-n", "--hosts", type=int, action="append",
+                            help="number of hosts, may be repeated (default: 1000, 10000, 50000)")
+        parser.add_argument("-r", "--runs", type=int, default=5)
+        parser.add_argument("--cache-path",
+                            help="directory to write the caches to (default: a temporary one)")
+        return parser.parse_args()
+
+    opts = process_arguments()
+    compressions = [None, 'zlib']
+    if cloud_inventory_cache.lzma is not None:
+        compressions.append('lzma')
+    else:
+        print('lzma is not available, install backports.lzma on Python 2')
+    cache_path = opts.cache_path or tempfile.mkdtemp()
+    try:
+        for count in opts.hosts or [1000, 10000, 50000]:
+            for compression in compressions:
+                size, load = measure(cache_path, count, compression, opts.runs)
+                print('%6d hosts  %-5s %9.1f KB  load %7.1f ms' % (
+                    count, compression or 'plain', size / 1024.0, load * 1000))
+    finally:
+        if not opts.cache_path:
+            shutil.rmtree(cache_path)
@@ -0,0 +1,152 @@
+"""
+Cache shared by the dynamic inventory scripts of this repository.
+
+The scripts add this directory to sys.path, relative to their own location,
+and import CloudInventoryCache from here. It is kept out of the inventory
+directories themselves, where Ansible would run it as an inventory source.
+"""
+
+import errno
+import fcntl
+import os
+import tempfile
+import zlib
+
+from time import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+class CloudInventoryCache(object):
+    '''
+    JSON file cache for the dynamic inventory scripts.
+
+    Every inventory script in this repository uses this class, so cache
+    behavior is tuned the same way for each provider:
+     - cache_max_age: seconds a cache file stays valid after it is written
+     - writes go to a temporary file renamed over the cache, so readers
+       never see a partially written file
+     - acquire_lock/release_lock serialize refreshes between processes
+     - compression: None, 'zlib' or 'lzma'. Compressed files are
+       recognized by their magic bytes on read, so caches written with
+       another setting, or plain ones, keep loading
+     - schema_version: part of the file name, so caches written by an
+       incompatible version of a script are never read
+     - stats: cache hits, misses and writes of the current run
+    '''
+
+    ZLIB_MAGIC = (b'\x78\x01', b'\x78\x5e', b'\x78\x9c', b'\x78\xda')
+    LZMA_MAGIC = b'\xfd7zXZ\x00'
+
+    def __init__(self, cache_name='ansible-cloud-cache', cache_path='/tmp',
+                 cache_max_age=300, compression=None, schema_version=1):
+        cache_dir = os.path.expanduser(cache_path)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        if schema_version:
+            root, ext = os.path.splitext(cache_name)
+            cache_name = '%s-v%d%s' % (root, schema_version, ext)
+        self.cache_path_cache = os.path.join(cache_dir, cache_name)
+        self.cache_path_lock = self.cache_path_cache + '.lock'
+        self.lock_fd = None
+
+        self.cache_max_age = cache_max_age
+        if compression and compression not in ('zlib', 'lzma'):
+            raise ValueError('Unsupported cache compression: %s' % compression)
+        if compression == 'lzma' and lzma is None:
+            raise ValueError('lzma cache compression requires Python 3 or backports.lzma')
+        self.compression = compression or None
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0}
+
+    def acquire_lock(self, blocking=True):
+        ''' Takes the exclusive refresh lock. Returns False when blocking is
+        False and another process already holds it. '''
+
+        if self.lock_fd is None:
+            self.lock_fd = os.open(self.cache_path_lock, os.O_RDWR | os.O_CREAT, 0o600)
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self.lock_fd, flags)
+        except IOError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        return True
+
+    def release_lock(self):
+        ''' Releases the refresh lock taken by acquire_lock. '''
+
+        if self.lock_fd is not None:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+            os.close(self.lock_fd)
+            self.lock_fd = None
+
+    def is_valid(self, max_age=None):
+        ''' Determines if the cache files have expired, or if it is still valid '''
+
+        if max_age is None:
+            max_age = self.cache_max_age
+
+        if os.path.isfile(self.cache_path_cache):
+            mod_time = os.path.getmtime(self.cache_path_cache)
+            current_time = time()
+            if (mod_time + max_age) > current_time:
+                self.stats['hits'] += 1
+                return True
+
+        self.stats['misses'] += 1
+        return False
+
+    def get_raw_data_from_cache(self, filename=''):
+        ''' Reads the cache file, decompressing it when needed. Returns the JSON text. '''
+
+        if not filename:
+            filename = self.cache_path_cache
+        with open(filename, 'rb') as cache:
+            data = cache.read()
+        if data[:2] in self.ZLIB_MAGIC:
+            data = zlib.decompress(data)
+        elif data[:6] == self.LZMA_MAGIC:
+            data = lzma.decompress(data)
+        return data.decode('utf-8')
+
+    def get_all_data_from_cache(self, filename=''):
+        ''' Reads the JSON inventory from the cache file. Returns Python dictionary. '''
+
+        return json.loads(self.get_raw_data_from_cache(filename))
+
+    def write_to_cache(self, data, filename=''):
+        ''' Writes data to file as JSON.  Returns True. '''
+        if not filename:
+            filename = self.cache_path_cache
+        json_data = json.dumps(data).encode('utf-8')
+        if self.compression == 'zlib':
+            json_data = zlib.compress(json_data)
+        elif self.compression == 'lzma':
+            json_data = lzma.compress(json_data)
+        # Write to a temporary file and rename it over the cache, so readers
+        # never see a partially written file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                        prefix=os.path.basename(filename))
+        try:
+            with os.fdopen(fd, 'wb') as cache:
+                cache.write(json_data)
+            os.rename(tmp_path, filename)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        self.stats['writes'] += 1
+        return True
@@ -1,30 +1,80 @@
 from ansible.errors import AnsibleError
 from ansible.plugins.lookup import LookupBase
 
+try:
+    from ansible.plugins.loader import lookup_loader
+except ImportError:
+    from ansible.plugins import lookup_loader
+
 import shade
 
 
+VOLUME_ATTRIBUTES = [
+    "id",
+    "name",
+    "display_name",
+    "size",
+    "description",
+]
+
+# Ansible creates a new LookupModule for every lookup, the volume index is
+# kept here to be shared by the lookups of a task. Ansible runs the lookups
+# of each task and host in a worker process of its own, so it never outlives
+# the task.
+_volume_index = None
+
+
+def get_cloud():
+    """Return the cloud client of the os_servers lookup, so the lookups of a
+    task share one authenticated session."""
+    os_servers = lookup_loader.get('os_servers')
+    if os_servers is None:
+        return shade.openstack_cloud()
+    return os_servers.get_cloud()
+
+
+def build_volume_index(volumes):
+    """Map the IDs, names and display names of volumes to their volumes.
+
+    A name shared by several volumes maps to all of them.
+    """
+    index = {}
+    for volume in volumes:
+        keys = set([volume.id, volume.name, getattr(volume, 'display_name', None)])
+        for key in keys:
+            if key:
+                index.setdefault(key, []).append(volume)
+    return index
+
+
+def get_volume_index(cache=False):
+    """List the volumes once and index them, see build_volume_index.
+
+    With cache the index of a previous lookup of the same task is reused.
+    """
+    global _volume_index
+    if _volume_index is None or not cache:
+        _volume_index = build_volume_index(get_cloud().list_volumes())
+    return _volume_index
+
+
 class LookupModule(LookupBase):
 
-    def run(self, volume_names, variables=None, **kwargs):
-        cloud = shade.openstack_cloud()
-        volume_attributes = [
-            "id",
-            "name",
-            "display_name",
-            "size",
-            "description",
-        ]
+    def run(self, volume_names, variables=None, cache=False, **kwargs):
+        index = get_volume_index(cache)
 
         def get_volume(name_or_id):
-            volume = cloud.get_volume(name_or_id)
-            if not volume:
+            volumes = index.get(name_or_id, [])
+            if not volumes:
                 raise AnsibleError(
                     "Could not find volume: {}".format(name_or_id))
+            if len(volumes) > 1:
+                raise AnsibleError(
+                    "Multiple volumes match: {}".format(name_or_id))
 
             result = {}
-            for attribute_name in volume_attributes:
-                result[attribute_name] = getattr(volume, attribute_name)
+            for attribute_name in VOLUME_ATTRIBUTES:
+                result[attribute_name] = getattr(volumes[0], attribute_name)
             return result
 
         return [get_volume(volume_name) for volume_name in volume_names]
@@ -0,0 +1,85 @@
+import json
+import os
+import tempfile
+
+from ansible.plugins.lookup import LookupBase
+
+import shade
+
+
+# Ansible creates a new LookupModule for every lookup, the cloud client and
+# the server listings are kept here to be shared by the lookups of a task,
+# other plugins reach them through lookup_loader.get('os_servers'). Ansible
+# runs the lookups of each task and host in a worker process of its own, so
+# only the cache file written for inventory.py outlives the task.
+_cloud = None
+_servers = {}
+
+
+def get_cloud():
+    global _cloud
+    if _cloud is None:
+        _cloud = shade.openstack_cloud()
+    return _cloud
+
+
+def cache_file(cluster_id=None):
+    """Path of the server listing shared with the sample inventory.py.
+
+    It is the file inventory.py names 'ansible-openstack-servers-<cluster>'.
+    """
+    cache_dir = os.path.expanduser(
+        os.environ.get('OPENSTACK_INVENTORY_CACHE_PATH', '~/.ansible/tmp'))
+    return os.path.join(
+        cache_dir, 'ansible-openstack-servers-%s-v1.cache' % (cluster_id or 'all'))
+
+
+def write_cache(cluster_id, data):
+    """Write the JSON server listing to the cache file through a rename, so
+    readers never see a partially written file."""
+    filename = cache_file(cluster_id)
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                    prefix=os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'w') as cache:
+            cache.write(data)
+        os.rename(tmp_path, filename)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def list_servers(cluster_id=None, refresh=False):
+    """List the servers, only the ones named after cluster_id if given.
+
+    Nova filters the servers by name, the servers of a cluster being named
+    `<type>-<index>.<cluster_id>`. The listing is made once per task unless
+    refresh is set, and is written to the cache file for inventory.py when
+    OPENSTACK_INVENTORY_CACHE_MAX_AGE enables its cache.
+    """
+    if refresh or cluster_id not in _servers:
+        if cluster_id:
+            servers = get_cloud().list_servers(filters={'name': cluster_id})
+        else:
+            servers = get_cloud().list_servers()
+        # Ansible templates the lookup results through their repr, so the
+        # servers are kept as plain dictionaries rather than shade Munch
+        data = json.dumps(servers)
+        if int(os.environ.get('OPENSTACK_INVENTORY_CACHE_MAX_AGE', 0)) > 0:
+            write_cache(cluster_id, data)
+        _servers[cluster_id] = json.loads(data)
+    return _servers[cluster_id]
+
+
+class LookupModule(LookupBase):
+
+    def run(self, terms, variables=None, refresh=False, **kwargs):
+        servers = []
+        for cluster_id in terms or [None]:
+            servers.extend(list_servers(cluster_id, refresh))
+        return servers
+
+    def get_cloud(self):
+        return get_cloud()
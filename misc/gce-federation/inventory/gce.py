@@ -111,48 +111,11 @@ except:
     sys.exit("GCE inventory script requires libcloud >= 0.13")
 
 
-class CloudInventoryCache(object):
-    def __init__(self, cache_name='ansible-cloud-cache', cache_path='/tmp',
-                 cache_max_age=300):
-        cache_dir = os.path.expanduser(cache_path)
-        if not os.path.exists(cache_dir):
-            os.makedirs(cache_dir)
-        self.cache_path_cache = os.path.join(cache_dir, cache_name)
-
-        self.cache_max_age = cache_max_age
-
-    def is_valid(self, max_age=None):
-        ''' Determines if the cache files have expired, or if it is still valid '''
-
-        if max_age is None:
-            max_age = self.cache_max_age
-
-        if os.path.isfile(self.cache_path_cache):
-            mod_time = os.path.getmtime(self.cache_path_cache)
-            current_time = time()
-            if (mod_time + max_age) > current_time:
-                return True
-
-        return False
-
-    def get_all_data_from_cache(self, filename=''):
-        ''' Reads the JSON inventory from the cache file. Returns Python dictionary. '''
-
-        data = ''
-        if not filename:
-            filename = self.cache_path_cache
-        with open(filename, 'r') as cache:
-            data = cache.read()
-        return json.loads(data)
-
-    def write_to_cache(self, data, filename=''):
-        ''' Writes data to file as JSON.  Returns True. '''
-        if not filename:
-            filename = self.cache_path_cache
-        json_data = json.dumps(data)
-        with open(filename, 'w') as cache:
-            cache.write(json_data)
-        return True
+# CloudInventoryCache is shared by the inventory scripts of this repository,
+# from its inventory/lib directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', '..', '..', 'inventory', 'lib'))
+from cloud_inventory_cache import CloudInventoryCache
 
 
 class GceInventory(object):
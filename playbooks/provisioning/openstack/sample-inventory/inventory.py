@@ -1,88 +1,187 @@
 #!/usr/bin/env python
+"""
+OpenStack dynamic inventory of an OpenShift cluster.
+
+Groups the servers carrying the `clusterid` metadata by their `host-type`,
+`sub-host-type` and `group` metadata. When the `OPENSHIFT_CLUSTER`
+environment variable is set, only the servers of that cluster are listed:
+Nova filters them by name, servers being named `<type>-<index>.<cluster>`,
+and their `clusterid` metadata must match.
+
+The server listing is cached in `OPENSTACK_INVENTORY_CACHE_PATH`, where the
+`os_servers` lookup plugin stores its listings too, and is reused for
+`OPENSTACK_INVENTORY_CACHE_MAX_AGE` seconds (0, the default, always lists
+the servers). Use --refresh-cache to force a refresh.
+"""
 
 from __future__ import print_function
 
+import argparse
 import json
+import os
+import sys
 
 import shade
 
 
-if __name__ == '__main__':
-    cloud = shade.openstack_cloud()
-
-    inventory = {}
-
-    # TODO(shadower): filter the servers based on the `OPENSHIFT_CLUSTER`
-    # environment variable.
-    cluster_hosts = [
-        server for server in cloud.list_servers()
-        if 'metadata' in server and 'clusterid' in server.metadata]
-
-    masters = [server.name for server in cluster_hosts
-               if server.metadata['host-type'] == 'master']
-
-    etcd = [server.name for server in cluster_hosts
-            if server.metadata['host-type'] == 'etcd']
-    if not etcd:
-        etcd = masters
-
-    infra_hosts = [server.name for server in cluster_hosts
-                   if server.metadata['host-type'] == 'node' and
-                   server.metadata['sub-host-type'] == 'infra']
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='OpenStack dynamic inventory of an OpenShift cluster',
+    )
+    parser.add_argument('--list', action='store_true', default=True,
+                        help='List servers (default: True)')
+    parser.add_argument('--host', help='Get all the variables about a server')
+    parser.add_argument('--refresh-cache', action='store_true', default=False,
+                        help='Force refresh of cache by making API requests to OpenStack')
+    return parser.parse_args()
+
+
+def create_cache(cluster_id, cache_max_age):
+    """
+    Return the cache of the server listing, or None when CloudInventoryCache
+    is not found. It is shared by the inventory scripts of this repository
+    from its inventory/lib directory, and only imported when the cache is
+    enabled. A copy of this inventory finds it in the
+    openshift-ansible-contrib checkout of the current directory, as the
+    copied ansible.cfg does, and runs without the cache elsewhere.
+    """
+    sys.path[:0] = [
+        os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                     '..', '..', '..', '..', 'inventory', 'lib'),
+        os.path.join('openshift-ansible-contrib', 'inventory', 'lib'),
+    ]
+    try:
+        from cloud_inventory_cache import CloudInventoryCache
+    except ImportError:
+        print('WARNING: cloud_inventory_cache not found, the server listing '
+              'is not cached', file=sys.stderr)
+        return None
+    return CloudInventoryCache(
+        cache_name='ansible-openstack-servers-%s.cache' % (cluster_id or 'all'),
+        cache_path=os.environ.get('OPENSTACK_INVENTORY_CACHE_PATH',
+                                  '~/.ansible/tmp'),
+        cache_max_age=cache_max_age,
+    )
+
+
+def list_servers(cluster_id=None, refresh=False):
+    """
+    List the servers, only the ones named after `cluster_id` if given: Nova
+    matches the server names against the cluster ID, so servers of other
+    clusters are not transferred. The listing is shared with the
+    `os_servers` lookup plugin through the cache.
+    """
+    cache = None
+    cache_max_age = int(os.environ.get('OPENSTACK_INVENTORY_CACHE_MAX_AGE', 0))
+    if cache_max_age > 0:
+        cache = create_cache(cluster_id, cache_max_age)
+    if cache is not None and not refresh and cache.is_valid():
+        return cache.get_all_data_from_cache()
 
-    app = [server.name for server in cluster_hosts
-           if server.metadata['host-type'] == 'node' and
-           server.metadata['sub-host-type'] == 'app']
-
-    nodes = list(set(masters + infra_hosts + app))
-
-    dns = [server.name for server in cluster_hosts
-           if server.metadata['host-type'] == 'dns']
-
-    lb = [server.name for server in cluster_hosts
-          if server.metadata['host-type'] == 'lb']
-
-    osev3 = list(set(nodes + etcd + lb))
-
-    groups = [server.metadata.group for server in cluster_hosts
-              if 'group' in server.metadata]
-
-    inventory['cluster_hosts'] = {'hosts': [s.name for s in cluster_hosts]}
-    inventory['OSEv3'] = {'hosts': osev3}
-    inventory['masters'] = {'hosts': masters}
-    inventory['etcd'] = {'hosts': etcd}
-    inventory['nodes'] = {'hosts': nodes}
-    inventory['infra_hosts'] = {'hosts': infra_hosts}
-    inventory['app'] = {'hosts': app}
-    inventory['dns'] = {'hosts': dns}
-    inventory['lb'] = {'hosts': lb}
+    cloud = shade.openstack_cloud()
+    if cluster_id:
+        servers = cloud.list_servers(filters={'name': cluster_id})
+    else:
+        servers = cloud.list_servers()
+    if cache is not None:
+        cache.write_to_cache(servers)
+    return servers
+
+
+def list_cluster_hosts(servers, cluster_id=None):
+    """
+    Return the `servers` carrying the `clusterid` metadata, only the ones
+    of `cluster_id` if given.
+    """
+    return [
+        server for server in servers
+        if 'clusterid' in server.get('metadata', {})
+        if cluster_id in (None, server['metadata']['clusterid'])]
+
+
+def host_vars(server):
+    """
+    Return the inventory variables of `server`.
+    """
+    ssh_ip_address = server.get('public_v4') or server.get('private_v4')
+    vars = {
+        'ansible_host': ssh_ip_address
+    }
+
+    public_v4 = server.get('public_v4') or server.get('private_v4')
+    if public_v4:
+        vars['public_v4'] = public_v4
+    # TODO(shadower): what about multiple networks?
+    if server.get('private_v4'):
+        vars['private_v4'] = server['private_v4']
+
+    node_labels = server['metadata'].get('node_labels')
+    if node_labels:
+        vars['openshift_node_labels'] = node_labels
+    return vars
+
+
+def build_inventory(cluster_hosts):
+    """
+    Classify `cluster_hosts` into the inventory groups in a single pass.
+    """
+    groups = dict(
+        (name, []) for name in (
+            'cluster_hosts', 'masters', 'etcd', 'infra_hosts', 'app', 'dns',
+            'lb'))
+    hostvars = {}
 
     for server in cluster_hosts:
-        if 'group' in server.metadata:
-            group = server.metadata.group
-            if group not in inventory:
-                inventory[group] = {'hosts': []}
-            inventory[group]['hosts'].append(server.name)
+        name = server['name']
+        host_type = server['metadata'].get('host-type')
+        groups['cluster_hosts'].append(name)
+        if host_type == 'master':
+            groups['masters'].append(name)
+        elif host_type == 'etcd':
+            groups['etcd'].append(name)
+        elif host_type == 'dns':
+            groups['dns'].append(name)
+        elif host_type == 'lb':
+            groups['lb'].append(name)
+        elif host_type == 'node':
+            sub_host_type = server['metadata'].get('sub-host-type')
+            if sub_host_type == 'infra':
+                groups['infra_hosts'].append(name)
+            elif sub_host_type == 'app':
+                groups['app'].append(name)
+
+        group = server['metadata'].get('group')
+        if group:
+            groups.setdefault(group, []).append(name)
+
+        hostvars[name] = host_vars(server)
+
+    if not groups['etcd']:
+        groups['etcd'] = groups['masters']
+    groups['nodes'] = sorted(
+        set(groups['masters'] + groups['infra_hosts'] + groups['app']))
+    groups['OSEv3'] = sorted(
+        set(groups['nodes'] + groups['etcd'] + groups['lb']))
+
+    inventory = dict((name, {'hosts': hosts}) for name, hosts in groups.items())
+    inventory['_meta'] = {'hostvars': hostvars}
+    return inventory
+
+
+def get_inventory(refresh=False):
+    """
+    Return the inventory of the cluster named by `OPENSHIFT_CLUSTER`, of all
+    the clusters if it is not set.
+    """
+    cluster_id = os.environ.get('OPENSHIFT_CLUSTER') or None
+    return build_inventory(
+        list_cluster_hosts(list_servers(cluster_id, refresh), cluster_id))
 
-    inventory['_meta'] = {'hostvars': {}}
 
-    for server in cluster_hosts:
-        ssh_ip_address = server.public_v4 or server.private_v4
-        vars = {
-            'ansible_host': ssh_ip_address
-        }
-
-        public_v4 = server.public_v4 or server.private_v4
-        if public_v4:
-            vars['public_v4'] = public_v4
-        # TODO(shadower): what about multiple networks?
-        if server.private_v4:
-            vars['private_v4'] = server.private_v4
-
-        node_labels = server.metadata.get('node_labels')
-        if node_labels:
-            vars['openshift_node_labels'] = node_labels
-
-        inventory['_meta']['hostvars'][server.name] = vars
+if __name__ == '__main__':
+    args = parse_args()
+    inventory = get_inventory(args.refresh_cache)
+    if args.host:
+        inventory = inventory['_meta']['hostvars'].get(args.host, {})
 
     print(json.dumps(inventory, indent=4, sort_keys=True))
@@ -89,6 +89,9 @@ USER_AGENT_VERSION = "v2"
 import sys
 import os
 import argparse
+import hashlib
+
+from collections import defaultdict
 
 from time import time
 
@@ -105,56 +108,11 @@ try:
 except ImportError:
     import simplejson as json
 
-try:
-    from libcloud.compute.types import Provider
-    from libcloud.compute.providers import get_driver
-    _ = Provider.GCE
-except:
-    sys.exit("GCE inventory script requires libcloud >= 0.13")
-
-
-class CloudInventoryCache(object):
-    def __init__(self, cache_name='ansible-cloud-cache', cache_path='/tmp',
-                 cache_max_age=300):
-        cache_dir = os.path.expanduser(cache_path)
-        if not os.path.exists(cache_dir):
-            os.makedirs(cache_dir)
-        self.cache_path_cache = os.path.join(cache_dir, cache_name)
-
-        self.cache_max_age = cache_max_age
-
-    def is_valid(self, max_age=None):
-        ''' Determines if the cache files have expired, or if it is still valid '''
-
-        if max_age is None:
-            max_age = self.cache_max_age
-
-        if os.path.isfile(self.cache_path_cache):
-            mod_time = os.path.getmtime(self.cache_path_cache)
-            current_time = time()
-            if (mod_time + max_age) > current_time:
-                return True
-
-        return False
-
-    def get_all_data_from_cache(self, filename=''):
-        ''' Reads the JSON inventory from the cache file. Returns Python dictionary. '''
-
-        data = ''
-        if not filename:
-            filename = self.cache_path_cache
-        with open(filename, 'r') as cache:
-            data = cache.read()
-        return json.loads(data)
-
-    def write_to_cache(self, data, filename=''):
-        ''' Writes data to file as JSON.  Returns True. '''
-        if not filename:
-            filename = self.cache_path_cache
-        json_data = json.dumps(data)
-        with open(filename, 'w') as cache:
-            cache.write(json_data)
-        return True
+# CloudInventoryCache is shared by the inventory scripts of this repository,
+# from its inventory/lib directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', '..', '..', '..', '..', '..', 'inventory', 'lib'))
+from cloud_inventory_cache import CloudInventoryCache
 
 
 class GceInventory(object):
@@ -163,11 +121,12 @@ class GceInventory(object):
         self.cache = None
         # dictionary containing inventory read from disk
         self.inventory = {}
+        # libcloud driver, only built once an API call is needed
+        self._driver = None
 
         # Read settings and parse CLI arguments
         self.parse_cli_args()
         self.config = self.get_config()
-        self.driver = self.get_gce_driver()
         self.ip_type = self.get_inventory_options()
         if self.ip_type:
             self.ip_type = self.ip_type.lower()
@@ -176,14 +135,14 @@ class GceInventory(object):
         start_inventory_time = time()
         cache_used = False
         if self.args.refresh_cache or not self.cache.is_valid():
-            self.do_api_calls_update_cache()
+            cache_used = self.refresh_cache()
         else:
             self.load_inventory_from_cache()
             cache_used = True
-            self.inventory['_meta']['stats'] = {'use_cache': True}
         self.inventory['_meta']['stats'] = {
             'inventory_load_time': time() - start_inventory_time,
-            'cache_used': cache_used
+            'cache_used': cache_used,
+            'cache_stats': self.cache.stats
         }
 
         # Just display data for specific host
@@ -223,8 +182,12 @@ class GceInventory(object):
             'gce_zone': '',
             'libcloud_secrets': '',
             'inventory_ip_type': '',
+            'group_by_ip': 'true',
             'cache_path': '~/.ansible/tmp',
-            'cache_max_age': '300'
+            'cache_max_age': '300',
+            'cache_compression': '',
+            'page_size': '500',
+            'zone_query_limit': '4'
         })
         if 'gce' not in config.sections():
             config.add_section('gce')
@@ -247,16 +210,45 @@ class GceInventory(object):
             if states:
                 self.instance_states = states.split(',')
 
+        # One group per private and public IP address
+        self.group_by_ip = config.getboolean('inventory', 'group_by_ip')
+
+        # Number of instances requested per API page (GCE allows up to 500)
+        self.page_size = config.getint('gce', 'page_size')
+
+        # Up to this many GCE_ZONE entries are listed zone by zone in
+        # parallel, longer lists fall back to one aggregated listing
+        self.zone_query_limit = config.getint('gce', 'zone_query_limit')
+
         # Caching
         cache_path = config.get('cache', 'cache_path')
         cache_max_age = config.getint('cache', 'cache_max_age')
-        # TOOD(supertom): support project-specific caches
-        cache_name = 'ansible-gce.cache'
+        # Caches are keyed by project and credentials, so several projects
+        # or service accounts never share a cache file, and by the zones and
+        # instance states listed, which select the instances cached
+        project = os.environ.get('GCE_PROJECT', config.get('gce', 'gce_project_id'))
+        credentials = '%s:%s' % (
+            os.environ.get('GCE_EMAIL', config.get('gce', 'gce_service_account_email_address')),
+            os.environ.get('GCE_CREDENTIALS_FILE_PATH', os.environ.get(
+                'GCE_PEM_FILE_PATH', config.get('gce', 'gce_service_account_pem_file_path'))))
+        selection = '%s:%s' % (','.join(sorted(self.parse_env_zones())), ','.join(sorted(self.instance_states)))
+        cache_key = hashlib.sha1(('%s:%s:%s' % (project, credentials, selection)).encode('utf-8')).hexdigest()[:12]
+        cache_name = 'ansible-gce-%s-%s.cache' % (project or 'default', cache_key)
+        cache_compression = config.get('cache', 'cache_compression')
         self.cache = CloudInventoryCache(cache_path=cache_path,
                                          cache_max_age=cache_max_age,
-                                         cache_name=cache_name)
+                                         cache_name=cache_name,
+                                         compression=cache_compression)
         return config
 
+    @property
+    def driver(self):
+        '''The libcloud driver, built on first use so that cache hits never
+        import libcloud nor authenticate.'''
+        if self._driver is None:
+            self._driver = self.get_gce_driver()
+        return self._driver
+
     def get_inventory_options(self):
         """Determine inventory options. Environment variables always
         take precedence over configuration files."""
@@ -270,6 +262,13 @@ class GceInventory(object):
         """Determine the GCE authorization settings and return a
         libcloud driver.
         """
+        try:
+            from libcloud.compute.types import Provider
+            from libcloud.compute.providers import get_driver
+            _ = Provider.GCE
+        except:
+            sys.exit("GCE inventory script requires libcloud >= 0.13")
+
         # Attempt to get GCE params from a configuration file, if one
         # exists.
         secrets_path = self.config.get('gce', 'libcloud_secrets')
@@ -397,6 +396,32 @@ class GceInventory(object):
                 % (self.cache.cache_path_cache))
             raise
 
+    def refresh_cache(self):
+        ''' Refreshes the cache under the refresh lock so only one process
+        queries the API. While another process refreshes, a stale cache is
+        served as is. Returns True when the inventory came from the cache. '''
+
+        started = time()
+        if not self.cache.acquire_lock(blocking=False):
+            if not self.args.refresh_cache and os.path.isfile(self.cache.cache_path_cache):
+                self.load_inventory_from_cache()
+                return True
+            # Nothing to serve meanwhile, wait for the other refresher
+            self.cache.acquire_lock()
+
+        try:
+            # Another process may have refreshed the cache since it was found
+            # stale, a forced refresh only takes one written after it started
+            if self.cache.is_valid() and (
+                    not self.args.refresh_cache or
+                    os.path.getmtime(self.cache.cache_path_cache) >= started):
+                self.load_inventory_from_cache()
+                return True
+            self.do_api_calls_update_cache()
+        finally:
+            self.cache.release_lock()
+        return False
+
     def do_api_calls_update_cache(self):
         ''' Do API calls and save data in cache. '''
         zones = self.parse_env_zones()
@@ -404,93 +429,123 @@ class GceInventory(object):
         self.cache.write_to_cache(data)
         self.inventory = data
 
-    def list_nodes(self):
-        all_nodes = []
-        params, more_results = {'maxResults': 500}, True
-        while more_results:
-            self.driver.connection.gce_params = params
-            all_nodes.extend(self.driver.list_nodes())
-            more_results = 'pageToken' in params
-        return all_nodes
+    def iter_instance_items(self, driver, request_path):
+        '''Yields raw instance items page by page, following nextPageToken
+        until the last page.'''
+        params = {'maxResults': self.page_size}
+        while True:
+            response = driver.connection.request(
+                request_path, method='GET', params=params).object
+            items = response.get('items', [])
+            if isinstance(items, dict):
+                # aggregated lists are keyed by 'zones/<zone>'
+                items = [i for z in items.values() for i in z.get('instances', [])]
+            for item in items:
+                yield item
+            if 'nextPageToken' not in response:
+                break
+            params['pageToken'] = response['nextPageToken']
+
+    def is_wanted(self, item, zones=None):
+        '''Checks a raw instance item against the zone and instance_states
+        filters, so unwanted instances are never turned into nodes.'''
+        if zones and item['zone'].split('/')[-1] not in zones:
+            return False
+        # If the instance_states list is _empty_ then _ALL_ states are returned.
+        if self.instance_states and item['status'] not in self.instance_states:
+            return False
+        return True
+
+    def items_to_nodes(self, driver, items):
+        '''Yields the nodes of raw instance items. As driver.list_nodes
+        does, the boot disks are looked up in a volume dict filled by one
+        disks listing, rather than one listing per node, and instances
+        deleted while being listed are skipped.'''
+        from libcloud.common.google import ResourceNotFoundError
+        populated = False
+        try:
+            for item in items:
+                if not populated:
+                    driver._ex_populate_volume_dict()
+                    populated = True
+                try:
+                    yield driver._to_node(item, use_disk_cache=True)
+                except ResourceNotFoundError:
+                    continue
+        finally:
+            driver._ex_volume_dict = {}
+
+    def list_zone_nodes(self, zone):
+        '''Lists the wanted nodes of a single zone with a driver of its own,
+        as libcloud connections must not be shared between threads.'''
+        driver = self.get_gce_driver()
+        items = self.iter_instance_items(driver, '/zones/%s/instances' % zone)
+        return list(self.items_to_nodes(driver, (item for item in items
+                                                 if self.is_wanted(item))))
+
+    def iter_nodes(self, zones=None):
+        '''Yields the wanted nodes. A short zone list is queried zone by zone
+        in parallel, otherwise the aggregated list is used and filtered.'''
+        if zones and len(zones) <= self.zone_query_limit:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(len(zones))
+            try:
+                for nodes in pool.imap_unordered(self.list_zone_nodes, zones):
+                    for node in nodes:
+                        yield node
+            finally:
+                pool.close()
+            return
+
+        items = self.iter_instance_items(self.driver, '/aggregated/instances')
+        for node in self.items_to_nodes(self.driver, (item for item in items
+                                                      if self.is_wanted(item, zones))):
+            yield node
+
+    def list_nodes(self, zones=None):
+        return list(self.iter_nodes(zones))
+
+    def node_group_names(self, node):
+        '''Returns the names of all groups a node belongs to'''
+        names = [node.extra['zone'].name]
+
+        for t in node.extra['tags']:
+            if t.startswith('group-'):
+                names.append(t[6:])
+            else:
+                names.append('tag_%s' % t)
+
+        net = node.extra['networkInterfaces'][0]['network'].split('/')[-1]
+        names.append('network_%s' % net)
+
+        names.append(node.size)
+        names.append(node.image and node.image or 'persistent_disk')
+        names.append('status_%s' % node.extra['status'].lower())
+
+        if self.group_by_ip:
+            names.extend(node.private_ips)
+            names.extend(node.public_ips)
+
+        return names
 
     def group_instances(self, zones=None):
         '''Group all instances'''
-        groups = {}
+        groups = defaultdict(list)
         meta = {}
         meta["hostvars"] = {}
 
-        for node in self.list_nodes():
-
-            # This check filters on the desired instance states defined in the
-            # config file with the instance_states config option.
-            #
-            # If the instance_states list is _empty_ then _ALL_ states are returned.
-            #
-            # If the instance_states list is _populated_ then check the current
-            # state against the instance_states list
-            if self.instance_states and not node.extra['status'] in self.instance_states:
-                continue
+        # Zone and instance_states filtering happens in iter_nodes, before
+        # the API items are turned into nodes
+        for node in self.iter_nodes(zones):
 
             name = node.name
 
             meta["hostvars"][name] = self.node_to_dict(node)
 
-            zone = node.extra['zone'].name
-
-            # To avoid making multiple requests per zone
-            # we list all nodes and then filter the results
-            if zones and zone not in zones:
-                continue
-
-            if zone in groups:
-                groups[zone].append(name)
-            else:
-                groups[zone] = [name]
-
-            tags = node.extra['tags']
-            for t in tags:
-                if t.startswith('group-'):
-                    tag = t[6:]
-                else:
-                    tag = 'tag_%s' % t
-                if tag in groups:
-                    groups[tag].append(name)
-                else:
-                    groups[tag] = [name]
-
-            net = node.extra['networkInterfaces'][0]['network'].split('/')[-1]
-            net = 'network_%s' % net
-            if net in groups:
-                groups[net].append(name)
-            else:
-                groups[net] = [name]
-
-            machine_type = node.size
-            if machine_type in groups:
-                groups[machine_type].append(name)
-            else:
-                groups[machine_type] = [name]
-
-            image = node.image and node.image or 'persistent_disk'
-            if image in groups:
-                groups[image].append(name)
-            else:
-                groups[image] = [name]
-
-            status = node.extra['status']
-            stat = 'status_%s' % status.lower()
-            if stat in groups:
-                groups[stat].append(name)
-            else:
-                groups[stat] = [name]
-
-            for private_ip in node.private_ips:
-                groups[private_ip] = [name]
-
-            if len(node.public_ips) >= 1:
-                for public_ip in node.public_ips:
-                    groups[public_ip] = [name]
+            for group in self.node_group_names(node):
+                groups[group].append(name)
 
+        groups = dict(groups)
         groups["_meta"] = meta
 
         return groups
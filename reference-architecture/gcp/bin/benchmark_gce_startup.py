@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+# Measure the startup of the GCE inventory script on a cache hit
+#
+# Writes a valid cache of --hosts synthetic hosts for a throwaway gce.ini,
+# then times --runs runs of `gce.py --list` served from it, each in a new
+# interpreter, in these modes:
+#  - python: a bare interpreter start, the floor of every mode
+#  - lazy: gce.py as it is, libcloud is never imported on a cache hit
+#  - import: the libcloud GCE driver imported before gce.py runs, as the
+#    script used to do at its top, without authenticating
+#  - driver: the driver built before the cache check, as the script used
+#    to do. It authenticates against GCE, so it only runs with --driver
+#    and the credentials of a real project in the environment (GCE_EMAIL,
+#    GCE_CREDENTIALS_FILE_PATH, GCE_PROJECT)
+# The median and best wall time of each mode are printed.
+#
+
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+HOSTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          '..', 'ansible', 'inventory', 'gce', 'hosts')
+sys.path.insert(0, HOSTS_PATH)
+
+import gce
+
+
+BOOTSTRAP = """
+import sys
+sys.argv = ['gce.py', '--list']
+sys.path.insert(0, %(path)r)
+%(before)s
+import gce
+%(patch)s
+gce.GceInventory()
+"""
+
+MODES = {
+    'python': None,
+    'lazy': {'before': '', 'patch': ''},
+    'import': {
+        'before': 'from libcloud.compute.types import Provider\n'
+                  'from libcloud.compute.providers import get_driver\n'
+                  'get_driver(Provider.GCE)',
+        'patch': ''},
+    'driver': {
+        'before': '',
+        'patch': 'options = gce.GceInventory.get_inventory_options\n'
+                 'def eager(self):\n'
+                 '    self.driver\n'
+                 '    return options(self)\n'
+                 'gce.GceInventory.get_inventory_options = eager'},
+}
+
+
+def make_inventory(count):
+    hostvars = {}
+    groups = {}
+    for i in range(count):
+        name = 'node-%05d' % i
+        zone = 'us-central1-%s' % 'abc'[i % 3]
+        hostvars[name] = {
+            'gce_name': name, 'gce_zone': zone, 'gce_status': 'RUNNING',
+            'gce_machine_type': 'n1-standard-4', 'gce_image': None,
+            'gce_private_ip': '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+            'gce_public_ip': None, 'gce_tags': ['ocp', 'node'],
+            'gce_metadata': {'ocp-cluster': 'ocp'}, 'gce_network': 'ocp-network',
+            'gce_subnetwork': None, 'gce_description': '',
+            'ansible_ssh_host': name}
+        for group in (zone, 'tag_ocp', 'tag_node', 'status_running'):
+            groups.setdefault(group, []).append(name)
+    groups['_meta'] = {'hostvars': hostvars}
+    return groups
+
+
+def write_cache(directory, count):
+    '''
+    Writes gce.ini and the cache gce.py reads with it, returns the path of
+    gce.ini.
+    '''
+    ini_path = os.path.join(directory, 'gce.ini')
+    with open(ini_path, 'w') as ini:
+        ini.write('[cache]\ncache_path = %s\ncache_max_age = 86400\n' % directory)
+    os.environ['GCE_INI_PATH'] = ini_path
+    inventory = gce.GceInventory.__new__(gce.GceInventory)
+    inventory.get_config()
+    inventory.cache.write_to_cache(make_inventory(count))
+    return ini_path
+
+
+def run(mode, runs):
+    if MODES[mode] is None:
+        command = [sys.executable, '-c', 'pass']
+    else:
+        command = [sys.executable, '-c', BOOTSTRAP % dict(MODES[mode], path=HOSTS_PATH)]
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.check_call(command, stdout=devnull)
+            times.append(time.time() - start)
+    times.sort()
+    return times[len(times) // 2], times[0]
+
+
+if __name__ == "__main__":
+
+    def process_arguments():
+        parser = ArgumentParser()
+        parser.add_argument("-n", "--hosts", type=int, default=1000)
+        parser.add_argument("-r", "--runs", type=int, default=10)
+        parser.add_argument("--driver", action="store_true",
+                            help="also build the driver before the cache check, needs credentials")
+        return parser.parse_args()
+
+    opts = process_arguments()
+    write_cache(tempfile.mkdtemp(), opts.hosts)
+    modes = ['python', 'lazy', 'import'] + (['driver'] if opts.driver else [])
+    for mode in modes:
+        try:
+            median, best = run(mode, opts.runs)
+        except subprocess.CalledProcessError:
+            print('%-8s failed, see the error above' % mode)
+            continue
+        print('%-8s %6d hosts  median %6.3fs  best %6.3fs' % (mode, opts.hosts, median, best))
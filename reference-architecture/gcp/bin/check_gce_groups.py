@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#
+# Check the grouping of the GCE inventory script against the previous one
+#
+# Builds --nodes synthetic libcloud nodes, --shared-ips of which reuse the
+# private address of another node (as instances of different networks do),
+# and groups them with GceInventory.group_instances and with the grouping
+# the script used before node_group_names, kept below as it was. The outputs
+# must be the same, but for the address groups of the shared addresses: the
+# previous grouping kept only the last node of each, they must now hold every
+# node with that address. With group_by_ip off, the output must be the
+# previous one without the address groups. The exit status is 1 when a check
+# failed.
+#
+
+from __future__ import print_function
+
+import os
+import random
+import sys
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'ansible', 'inventory', 'gce', 'hosts'))
+
+import gce
+
+
+class Zone(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class Node(object):
+    pass
+
+
+def make_nodes(count, shared_ips, seed=1):
+    rand = random.Random(seed)
+    zones = [Zone('us-central1-%s' % z) for z in 'abcf']
+    nodes = []
+    for i in range(count):
+        node = Node()
+        node.name = 'node-%05d' % i
+        node.uuid = node.id = str(i)
+        node.image = rand.choice([None, 'rhel-7', 'rhel-7-gold'])
+        node.size = rand.choice(['n1-standard-1', 'n1-standard-4', 'g1-small'])
+        node.private_ips = ['10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255)]
+        node.public_ips = rand.choice([[], ['35.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255)]])
+        network = rand.choice(['default', 'ocp-network'])
+        node.extra = {
+            'zone': rand.choice(zones),
+            'tags': rand.sample(['ocp', 'group-masters', 'group-nodes', 'infra', 'app'], 2),
+            'networkInterfaces': [{'network': 'projects/p/global/networks/%s' % network}],
+            'status': rand.choice(['RUNNING', 'RUNNING', 'TERMINATED']),
+            'metadata': {'items': [{'key': 'ocp-cluster', 'value': 'ocp'}]},
+            'description': '',
+        }
+        nodes.append(node)
+    for node in rand.sample(nodes[1:], shared_ips):
+        node.private_ips = list(nodes[rand.randrange(int(node.id))].private_ips)
+    return nodes
+
+
+def previous_group_instances(inventory, nodes):
+    '''The grouping of gce.py before node_group_names, zone and
+    instance_states filtering aside.'''
+    groups = {}
+    meta = {}
+    meta["hostvars"] = {}
+
+    for node in nodes:
+        name = node.name
+
+        meta["hostvars"][name] = inventory.node_to_dict(node)
+
+        zone = node.extra['zone'].name
+        if zone in groups:
+            groups[zone].append(name)
+        else:
+            groups[zone] = [name]
+
+        tags = node.extra['tags']
+        for t in tags:
+            if t.startswith('group-'):
+                tag = t[6:]
+            else:
+                tag = 'tag_%s' % t
+            if tag in groups:
+                groups[tag].append(name)
+            else:
+                groups[tag] = [name]
+
+        net = node.extra['networkInterfaces'][0]['network'].split('/')[-1]
+        net = 'network_%s' % net
+        if net in groups:
+            groups[net].append(name)
+        else:
+            groups[net] = [name]
+
+        machine_type = node.size
+        if machine_type in groups:
+            groups[machine_type].append(name)
+        else:
+            groups[machine_type] = [name]
+
+        image = node.image and node.image or 'persistent_disk'
+        if image in groups:
+            groups[image].append(name)
+        else:
+            groups[image] = [name]
+
+        status = node.extra['status']
+        stat = 'status_%s' % status.lower()
+        if stat in groups:
+            groups[stat].append(name)
+        else:
+            groups[stat] = [name]
+
+        for private_ip in node.private_ips:
+            groups[private_ip] = [name]
+
+        if len(node.public_ips) >= 1:
+            for public_ip in node.public_ips:
+                groups[public_ip] = [name]
+
+    groups["_meta"] = meta
+
+    return groups
+
+
+def make_inventory(nodes, group_by_ip):
+    inventory = gce.GceInventory.__new__(gce.GceInventory)
+    inventory.ip_type = None
+    inventory.group_by_ip = group_by_ip
+    inventory.iter_nodes = lambda zones=None: iter(nodes)
+    return inventory
+
+
+def report(label, ok, detail):
+    print('%-10s %s%s' % (label, detail, '' if ok else '  FAILED'))
+    return ok
+
+
+if __name__ == "__main__":
+
+    def process_arguments():
+        parser = ArgumentParser()
+        parser.add_argument("-n", "--nodes", type=int, default=20000)
+        parser.add_argument("-s", "--shared-ips", type=int, default=200,
+                            help="nodes reusing the private address of another node")
+        return parser.parse_args()
+
+    opts = process_arguments()
+    nodes = make_nodes(opts.nodes, opts.shared_ips)
+    addresses = {}
+    for node in nodes:
+        for ip in node.private_ips + node.public_ips:
+            addresses.setdefault(ip, []).append(node.name)
+    shared = set(ip for ip, names in addresses.items() if len(names) > 1)
+
+    previous = previous_group_instances(make_inventory(nodes, True), nodes)
+    current = make_inventory(nodes, True).group_instances()
+
+    differ = set(k for k in set(previous) | set(current)
+                 if previous.get(k) != current.get(k))
+    ok = report('groups', differ == shared,
+                '%d groups, %d differ from the previous grouping, %d shared addresses' % (
+                    len(current) - 1, len(differ), len(shared)))
+    ok = report('hostvars', previous['_meta'] == current['_meta'],
+                '%d hosts' % len(current['_meta']['hostvars'])) and ok
+    complete = all(current[ip] == addresses[ip] for ip in addresses)
+    last = all(previous[ip] == addresses[ip][-1:] for ip in shared)
+    ok = report('addresses', complete and last,
+                'address groups hold every node with the address, '
+                'the previous one only the last') and ok
+
+    without = make_inventory(nodes, False).group_instances()
+    expected = dict((k, v) for k, v in previous.items() if k not in addresses)
+    ok = report('no ip', without == expected,
+                '%d groups with group_by_ip off' % (len(without) - 1)) and ok
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+#
+# Check the paging of the GCE inventory script against a stubbed endpoint
+#
+# Serves --instances instances spread over --zones zones, each with a
+# persistent boot disk, from a stub of the libcloud connection, pages of at
+# most --page-size items chained with nextPageToken as the GCE API does. The
+# boot disks of --deleted instances are missing, as for instances deleted
+# while being listed. The nodes are built by the GCENodeDriver of libcloud,
+# so the zones and disks listings it makes are counted too. Lists them
+# through the aggregated list, the aggregated list filtered on more zones
+# than zone_query_limit, and the parallel per-zone lists, and checks each
+# listing made exactly the expected number of requests, skipped the deleted
+# instances and lost or duplicated no other one. The first node must be
+# yielded before the second page of instances is requested. The exit status
+# is 1 when a check failed.
+#
+
+from __future__ import print_function
+
+import os
+import sys
+import threading
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'ansible', 'inventory', 'gce', 'hosts'))
+
+import gce
+from libcloud.compute.drivers.gce import GCENodeDriver
+
+ZONE_URL = 'https://www.googleapis.com/compute/v1/projects/p/zones/%s'
+
+
+class StubResponse(object):
+    def __init__(self, obj):
+        self.object = obj
+
+
+class StubConnection(object):
+    '''
+    Pages through the instances like the GCE instances list and aggregated
+    list calls, and serves the zones and disks listings of the driver,
+    counting the requests.
+    '''
+
+    def __init__(self, instances, zones, disks):
+        self.instances = instances
+        self.zones = zones
+        self.disks = disks
+        self.requests = 0
+        self.instance_requests = 0
+        self.lock = threading.Lock()
+
+    def count(self, requests=1, instances=False):
+        with self.lock:
+            self.requests += requests
+            if instances:
+                self.instance_requests += requests
+
+    def request_aggregated_items(self, api_name, zone=None):
+        # only the driver lists the disks, 500 per page
+        self.count(max(1, -(-len(self.disks) // 500)))
+        items = {}
+        for disk in self.disks:
+            zone = 'zones/%s' % disk['zone'].split('/')[-1]
+            items.setdefault(zone, {'disks': []})['disks'].append(disk)
+        return {'items': items}
+
+    def request(self, action, method='GET', params=None):
+        if action == '/zones':
+            self.count()
+            return StubResponse({'items': [
+                {'id': str(i), 'name': zone, 'status': 'UP', 'selfLink': ZONE_URL % zone}
+                for i, zone in enumerate(self.zones)]})
+        self.count(instances=True)
+        if action == '/aggregated/instances':
+            instances = self.instances
+        else:
+            zone = action.split('/')[2]
+            instances = [i for i in self.instances if i['zone'].endswith('/' + zone)]
+
+        start = int(params.get('pageToken', 0))
+        end = start + min(params['maxResults'], 500)
+        response = {}
+        if end < len(instances):
+            response['nextPageToken'] = str(end)
+        page = instances[start:end]
+        if action == '/aggregated/instances':
+            items = {}
+            for item in page:
+                zone = 'zones/%s' % item['zone'].split('/')[-1]
+                items.setdefault(zone, {'instances': []})['instances'].append(item)
+            response['items'] = items
+        else:
+            response['items'] = page
+        return StubResponse(response)
+
+
+def make_driver(connection):
+    '''
+    GCENodeDriver of libcloud talking to the stub connection, without
+    authenticating.
+    '''
+    driver = GCENodeDriver.__new__(GCENodeDriver)
+    driver.connection = connection
+    driver._zone_dict = None
+    driver._zone_list = None
+    driver._ex_volume_dict = {}
+    return driver
+
+
+def make_instances(count, zones, deleted):
+    '''
+    Returns the instances and the disks of the ones not deleted.
+    '''
+    instances = []
+    disks = []
+    for i in range(count):
+        zone = ZONE_URL % ('zone-%d' % (i % zones))
+        disk = {'id': str(i), 'name': 'node-%d' % i, 'zone': zone, 'sizeGb': '10',
+                'sourceImage': 'https://www.googleapis.com/compute/v1/projects/p/global/images/rhel-7'}
+        instances.append({
+            'id': str(i), 'name': 'node-%d' % i, 'zone': zone, 'status': 'RUNNING',
+            'machineType': zone + '/machineTypes/n1-standard-1',
+            'tags': {'fingerprint': 'f'},
+            'disks': [{'boot': True, 'type': 'PERSISTENT', 'source': zone + '/disks/node-%d' % i}],
+            'networkInterfaces': [{'network': 'global/networks/default', 'networkIP': '10.0.0.1'}]})
+        if i >= deleted:
+            disks.append(disk)
+    return instances, disks
+
+
+def make_inventory(connection, page_size, zone_query_limit):
+    '''
+    GceInventory with the settings get_config would read and the stub
+    driver, without running the script.
+    '''
+    inventory = gce.GceInventory.__new__(gce.GceInventory)
+    inventory.page_size = page_size
+    inventory.zone_query_limit = zone_query_limit
+    inventory.instance_states = []
+    inventory._driver = make_driver(connection)
+    inventory.get_gce_driver = lambda: make_driver(connection)
+    return inventory
+
+
+def pages(count, page_size):
+    return max(1, -(-count // min(page_size, 500)))
+
+
+def check(label, listing, zones, expected_requests, opts):
+    '''
+    Lists the nodes, expected_requests being the number of instances list
+    requests. The driver of each listing adds a zones listing and a disks
+    listing, and one more disks listing per deleted instance, as libcloud
+    looks a missing disk up again before giving up on it.
+    '''
+    instances, disks, zone_names = listing
+    connection = StubConnection(instances, zone_names, disks)
+    inventory = make_inventory(connection, opts.page_size, opts.zone_query_limit)
+    nodes = [node.name for node in inventory.list_nodes(zones)]
+    listed = [i['name'] for i in instances
+              if not zones or i['zone'].split('/')[-1] in zones]
+    deleted = set(listed) - set(d['name'] for d in disks)
+    wanted = set(listed) - deleted
+    drivers = len(zones) if zones and len(zones) <= opts.zone_query_limit else 1
+    expected_requests += (drivers * (1 + pages(len(disks), 500)) +
+                          len(deleted) * pages(len(disks), 500))
+    lost = len(wanted - set(nodes))
+    duplicated = len(nodes) - len(set(nodes))
+    kept = len(deleted & set(nodes))
+    ok = (connection.requests == expected_requests and not lost and
+          not duplicated and not kept)
+    print('%-12s %6d nodes %4d requests (expected %d), %d lost, %d duplicated, '
+          '%d of %d deleted kept%s' % (
+              label, len(nodes), connection.requests, expected_requests, lost,
+              duplicated, kept, len(deleted), '' if ok else '  FAILED'))
+    return ok
+
+
+def check_streaming(listing, opts):
+    instances, disks, zone_names = listing
+    connection = StubConnection(instances, zone_names, disks)
+    inventory = make_inventory(connection, opts.page_size, opts.zone_query_limit)
+    next(inventory.iter_nodes())
+    ok = connection.instance_requests == 1
+    print('%-12s first node after %d instances request(s)%s' % (
+        'streaming', connection.instance_requests, '' if ok else '  FAILED'))
+    return ok
+
+
+if __name__ == "__main__":
+
+    def process_arguments():
+        parser = ArgumentParser()
+        parser.add_argument("-n", "--instances", type=int, default=5200)
+        parser.add_argument("-z", "--zones", type=int, default=8)
+        parser.add_argument("-p", "--page-size", type=int, default=500)
+        parser.add_argument("--zone-query-limit", type=int, default=4)
+        parser.add_argument("-d", "--deleted", type=int, default=3,
+                            help="instances deleted while being listed")
+        return parser.parse_args()
+
+    opts = process_arguments()
+    instances, disks = make_instances(opts.instances, opts.zones, opts.deleted)
+    zone_names = ['zone-%d' % i for i in range(opts.zones)]
+    listing = (instances, disks, zone_names)
+
+    ok = check('aggregated', listing, None,
+               pages(len(instances), opts.page_size), opts)
+
+    # more zones than zone_query_limit, the aggregated list is filtered
+    zones = zone_names[:opts.zone_query_limit + 1]
+    ok = check('filtered', listing, zones,
+               pages(len(instances), opts.page_size), opts) and ok
+
+    # up to zone_query_limit zones, listed zone by zone
+    zones = zone_names[:opts.zone_query_limit]
+    ok = check('per zone', listing, zones,
+               sum(pages(len([i for i in instances if i['zone'].endswith('/' + z)]),
+                         opts.page_size) for z in zones), opts) and ok
+
+    if len(instances) > opts.page_size:
+        ok = check_streaming(listing, opts) and ok
+    sys.exit(0 if ok else 1)
@@ -2,28 +2,354 @@
 #
 # Add an A record to a DNS server via RFC 2136 dynamic update
 #
+# In batch mode (--file) the records are read as "name address [zone]"
+# lines, from stdin when the file is "-". The records of a zone are sent in
+# as few UPDATE messages as fit in a TCP message, over one TCP connection per
+# zone, and the zones are updated by --jobs concurrent connections. The
+# addresses of a name listed several times make up its record set.
+#
+# With --sync the current A records of the zone are read once, by AXFR or by
+# queries pipelined over the TCP connection, and only the adds and deletes
+# needed to reach the records of the file are sent. Names missing from the
+# file are left alone.
+#
 
 import os,sys
+import socket
+import struct
+import time
 from argparse import ArgumentParser
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 # python2-dns
+import dns.exception
+import dns.inet
+import dns.message
+import dns.name
 import dns.query
+import dns.rdataclass
+import dns.rdatatype
 import dns.tsigkeyring
 import dns.update
 import dns.rcode
+import dns.zone
+
+
+# dns.query.send_tcp and receive_tcp appeared in dnspython 1.16, RHEL 7
+# ships python2-dns 1.12: send and read the length-prefixed messages here
+try:
+    send_tcp = dns.query.send_tcp
+    receive_tcp = dns.query.receive_tcp
+except AttributeError:
+    def recv_exactly(sock, count, expiration):
+        data = b''
+        while len(data) < count:
+            if time.time() > expiration:
+                raise dns.exception.Timeout
+            chunk = sock.recv(count - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def send_tcp(sock, wire, expiration=None):
+        sock.sendall(struct.pack('!H', len(wire)) + wire)
+        return len(wire) + 2, time.time()
 
+    def receive_tcp(sock, expiration=None, keyring=None, request_mac=''):
+        expiration = expiration or float('inf')
+        length, = struct.unpack('!H', recv_exactly(sock, 2, expiration))
+        wire = recv_exactly(sock, length, expiration)
+        return (dns.message.from_wire(wire, keyring=keyring,
+                                      request_mac=request_mac),
+                time.time())
 
-def add_a_record(server, zone, key, name, address, ttl=300):
+
+def add_a_record(server, zone, key, name, address, ttl=300, port=53):
 
     # make input zones absolute
     #zone = zone + '.' if not zone.endswith('.')
     keyring = dns.tsigkeyring.from_text({'update-key': key})
     update = dns.update.Update(zone, keyring=keyring)
     update.replace(name, ttl, 'a', address)
-    response = dns.query.tcp(update, server)
+    response = dns.query.tcp(update, server, port=port)
     return response
-    
-    
+
+
+def read_records(lines, zone):
+    """
+    Parse "name address [zone]" lines, skipping blank and # comment lines.
+    Return a dictionary of zone to list of (name, address) pairs.
+    """
+    records = OrderedDict()
+    for line in lines:
+        fields = line.split('#', 1)[0].split()
+        if not fields:
+            continue
+        if len(fields) not in (2, 3):
+            raise ValueError("expected 'name address [zone]': %s" % line.strip())
+        records.setdefault(fields[2] if len(fields) == 3 else zone, []).append(
+            (fields[0], fields[1]))
+    return records
+
+
+def make_updates(zone, keyring, changes, ttl=300, batch_size=500):
+    """
+    Group the (op, name, address) changes, op being 'replace', 'add' or
+    'delete', into UPDATE messages of at most batch_size changes, splitting
+    the ones too big for a TCP message.
+    Return a list of (update, wire, changes) tuples.
+    """
+    updates = []
+    pending = [changes[i:i + batch_size]
+               for i in range(0, len(changes), batch_size)]
+    while pending:
+        batch = pending.pop(0)
+        update = dns.update.Update(zone, keyring=keyring)
+        for op, name, address in batch:
+            if op == 'delete':
+                update.delete(name, 'a', address)
+            else:
+                getattr(update, op)(name, ttl, 'a', address)
+        try:
+            wire = update.to_wire()
+        except dns.exception.TooBig:
+            if len(batch) == 1:
+                raise
+            half = len(batch) // 2
+            pending[:0] = [batch[:half], batch[half:]]
+            continue
+        updates.append((update, wire, batch))
+    return updates
+
+
+class UpdateConnection(object):
+    """
+    TCP connection to the DNS server, reused for every message sent through
+    it and reopened once when the server closed it.
+    """
+
+    def __init__(self, server, port=53, timeout=30):
+        self.server = server
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+
+    def connect(self):
+        af = dns.inet.af_for_address(self.server)
+        self.sock = socket.socket(af, socket.SOCK_STREAM, 0)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect((self.server, self.port))
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def send(self, update, wire):
+        return self.pipeline([(update, wire)])[0]
+
+    def pipeline(self, requests):
+        """
+        Send the (message, wire) requests, which must have distinct ids,
+        before reading the responses, which the server may return in any
+        order. Only a single request may be TSIG signed.
+        Return the responses in the order of the requests.
+        """
+        keyring, request_mac = None, ''
+        if len(requests) == 1:
+            keyring, request_mac = requests[0][0].keyring, requests[0][0].mac
+        for attempt in (1, 2):
+            if self.sock is None:
+                self.connect()
+            try:
+                expiration = time.time() + self.timeout
+                for message, wire in requests:
+                    send_tcp(self.sock, wire, expiration)
+                responses = {}
+                for message, wire in requests:
+                    response, _ = receive_tcp(
+                        self.sock, expiration, keyring=keyring,
+                        request_mac=request_mac)
+                    responses[response.id] = response
+                break
+            except (EOFError, socket.error):
+                self.close()
+                if attempt == 2:
+                    raise
+        for message, wire in requests:
+            if not message.is_response(responses.get(message.id, message)):
+                raise dns.query.BadResponse
+        return [responses[message.id] for message, wire in requests]
+
+
+def send_changes(connection, zone, keyring, changes, ttl=300, batch_size=500):
+    """
+    Send the (op, name, address) changes of zone, see make_updates, over
+    the connection. An UPDATE message is applied as a whole, so the changes
+    of a failed message are split in halves and resent, until the failing
+    changes are found.
+    Return a list of (op, name, address, rcode) tuples.
+    """
+    results = []
+    pending = make_updates(zone, keyring, changes, ttl, batch_size)
+    while pending:
+        update, wire, batch = pending.pop(0)
+        rcode = connection.send(update, wire).rcode()
+        if rcode != dns.rcode.NOERROR and len(batch) > 1:
+            half = (len(batch) + 1) // 2
+            pending[:0] = make_updates(zone, keyring, batch, ttl, half)
+        else:
+            results.extend(change + (rcode,) for change in batch)
+    return results
+
+
+def add_a_records(server, zone, key, records, ttl=300, batch_size=500,
+                  port=53, timeout=30):
+    """
+    Replace the A records of the (name, address) records of zone, grouped
+    in UPDATE messages sent over one TCP connection. The first address of a
+    name listed several times replaces its records, the others are added.
+    Return a list of (name, address, rcode) tuples.
+    """
+    keyring = dns.tsigkeyring.from_text({'update-key': key})
+    connection = UpdateConnection(server, port, timeout)
+    origin = dns.name.from_text(zone)
+    changes = []
+    replaced = set()
+    for name, address in OrderedDict((record, None) for record in records):
+        qname = dns.name.from_text(name, origin)
+        changes.append(('add' if qname in replaced else 'replace', name, address))
+        replaced.add(qname)
+    try:
+        results = send_changes(connection, zone, keyring, changes, ttl,
+                               batch_size)
+    finally:
+        connection.close()
+    return [(name, address, rcode) for op, name, address, rcode in results]
+
+
+def get_a_records(connection, zone, keyring, names, method='auto',
+                  query_batch_size=100):
+    """
+    Read the A records of zone by AXFR, or with A queries of the names
+    pipelined over the connection. The 'auto' method falls back to the
+    queries when the transfer fails.
+    Return a dictionary of relative name to (ttl, set of addresses).
+    """
+    if method in ('auto', 'axfr'):
+        try:
+            xfr = dns.query.xfr(connection.server, zone, port=connection.port,
+                                keyring=keyring, keyname='update-key',
+                                timeout=connection.timeout)
+            return dict(
+                (name, (rdataset.ttl, set(rdata.address for rdata in rdataset)))
+                for name, rdataset in dns.zone.from_xfr(xfr).iterate_rdatasets('A'))
+        except (dns.exception.DNSException, EOFError, socket.error) as e:
+            if method == 'axfr':
+                raise
+            print >> sys.stderr, "WARNING: AXFR of %s failed, querying: %s" % (zone, e)
+
+    origin = dns.name.from_text(zone)
+    records = {}
+    for i in range(0, len(names), query_batch_size):
+        queries = []
+        for name in names[i:i + query_batch_size]:
+            query = dns.message.make_query(name.derelativize(origin), 'A')
+            query.id = len(queries)
+            queries.append((query, query.to_wire()))
+        for (query, wire), response in zip(queries, connection.pipeline(queries)):
+            qname = query.question[0].name
+            rrset = response.get_rrset(response.answer, qname,
+                                       dns.rdataclass.IN, dns.rdatatype.A)
+            if rrset is not None:
+                records[qname.relativize(origin)] = (
+                    rrset.ttl, set(rdata.address for rdata in rrset))
+    return records
+
+
+def diff_a_records(zone, records, current, ttl=300):
+    """
+    Compute the changes turning the current A records, as returned by
+    get_a_records, into the (name, address) records, the addresses of a
+    name listed several times making up its record set.
+    Return a list of (op, name, address) changes, see make_updates.
+    """
+    origin = dns.name.from_text(zone)
+    desired = OrderedDict()
+    for name, address in records:
+        addresses = desired.setdefault(name, [])
+        if address not in addresses:
+            addresses.append(address)
+
+    changes = []
+    for name, addresses in desired.items():
+        key = dns.name.from_text(name, origin).relativize(origin)
+        current_ttl, current_addresses = current.get(key, (ttl, set()))
+        if current_ttl != ttl:
+            changes.append(('replace', name, addresses[0]))
+            changes.extend(('add', name, address) for address in addresses[1:])
+            continue
+        changes.extend(('delete', name, address)
+                       for address in sorted(current_addresses - set(addresses)))
+        changes.extend(('add', name, address)
+                       for address in addresses if address not in current_addresses)
+    return changes
+
+
+def sync_a_records(server, zone, key, records, ttl=300, batch_size=500,
+                   port=53, timeout=30, method='auto'):
+    """
+    Bring the A records of the names of the (name, address) records of zone
+    in line with them, sending only the changes needed, see diff_a_records.
+    Return a list of (op, name, address, rcode) tuples.
+    """
+    keyring = dns.tsigkeyring.from_text({'update-key': key})
+    connection = UpdateConnection(server, port, timeout)
+    origin = dns.name.from_text(zone)
+    names = list(OrderedDict(
+        (dns.name.from_text(name, origin).relativize(origin), None)
+        for name, address in records))
+    try:
+        current = get_a_records(connection, zone, keyring, names, method)
+        return send_changes(connection, zone, keyring,
+                            diff_a_records(zone, records, current, ttl),
+                            ttl, batch_size)
+    finally:
+        connection.close()
+
+
+def add_a_records_batch(server, key, records, ttl=300, batch_size=500,
+                        port=53, timeout=30, jobs=1, sync=None):
+    """
+    Update the zones of the records dictionary, as returned by
+    read_records, with up to jobs zones updated concurrently. With sync set
+    to a get_a_records method, the zones are synced by sync_a_records.
+    Return a list of (zone, op, name, address, rcode) tuples.
+    """
+    def update_zone(zone):
+        try:
+            if sync:
+                return [(zone,) + result for result in sync_a_records(
+                    server, zone, key, records[zone], ttl, batch_size, port,
+                    timeout, sync)]
+            return [(zone, 'replace') + result for result in add_a_records(
+                server, zone, key, records[zone], ttl, batch_size, port,
+                timeout)]
+        except (dns.exception.DNSException, EOFError, socket.error) as e:
+            print >> sys.stderr, "ERROR: zone %s: %s" % (zone, e)
+            return [(zone, 'sync' if sync else 'replace', name, address,
+                     dns.rcode.SERVFAIL)
+                    for name, address in records[zone]]
+
+    pool = ThreadPool(max(1, min(jobs, len(records))))
+    try:
+        return sum(pool.map(update_zone, records), [])
+    finally:
+        pool.close()
+
+
 if __name__ == "__main__":
 
     def process_arguments():
@@ -31,15 +357,61 @@ if __name__ == "__main__":
         parser.add_argument("-s", "--server", type=str, default="127.0.0.1")
         parser.add_argument("-z", "--zone", type=str, default="example.com")
         parser.add_argument("-k", "--key", type=str, default=os.getenv("DNS_KEY"))
-        parser.add_argument("name", type=str)
-        parser.add_argument("address", type=str)
-        parser.add_argument("-t", "--ttl", type=str, default=300)
-        return parser.parse_args()
+        parser.add_argument("name", type=str, nargs="?")
+        parser.add_argument("address", type=str, nargs="?")
+        parser.add_argument("-t", "--ttl", type=int, default=300)
+        parser.add_argument("-f", "--file", type=str,
+                            help="batch mode: read 'name address [zone]' lines, '-' for stdin")
+        parser.add_argument("-b", "--batch-size", type=int, default=500,
+                            help="most records per UPDATE message in batch mode")
+        parser.add_argument("-j", "--jobs", type=int, default=4,
+                            help="zones updated concurrently in batch mode")
+        parser.add_argument("-p", "--port", type=int, default=53)
+        parser.add_argument("--sync", nargs="?", const="auto",
+                            choices=["auto", "axfr", "query"],
+                            help="batch mode: only send the changes needed, reading the "
+                                 "current records by AXFR, by queries or by AXFR falling "
+                                 "back to queries (auto, the default)")
+        opts = parser.parse_args()
+        if (opts.file is None) == (opts.name is None or opts.address is None):
+            parser.error("give either name and address, or --file")
+        if opts.sync and opts.file is None:
+            parser.error("--sync requires --file")
+        return opts
 
     opts = process_arguments()
-    r = add_a_record(opts.server, opts.zone, opts.key, opts.name, opts.address, opts.ttl)
 
-    if r.rcode() != dns.rcode.NOERROR:
-        print "ERROR: update failed: %s" % dns.rcode.to_text(r.rcode())
-        sys.exit(r.rcode())
+    if opts.file is None:
+        r = add_a_record(opts.server, opts.zone, opts.key, opts.name, opts.address, opts.ttl, opts.port)
+
+        if r.rcode() != dns.rcode.NOERROR:
+            print "ERROR: update failed: %s" % dns.rcode.to_text(r.rcode())
+            sys.exit(r.rcode())
+        sys.exit(0)
+
+    if opts.file == "-":
+        records = read_records(sys.stdin, opts.zone)
+    else:
+        with open(opts.file) as f:
+            records = read_records(f, opts.zone)
+
+    failed = 0
+    changed = set()
+    for zone, op, name, address, rcode in add_a_records_batch(
+            opts.server, opts.key, records, opts.ttl, opts.batch_size,
+            opts.port, jobs=opts.jobs, sync=opts.sync):
+        if opts.sync:
+            print "%s %s %s %s %s" % (zone, op, name, address, dns.rcode.to_text(rcode))
+        else:
+            print "%s %s %s %s" % (zone, name, address, dns.rcode.to_text(rcode))
+        changed.add((zone, name))
+        if rcode != dns.rcode.NOERROR:
+            failed += 1
 
+    if opts.sync:
+        names = set((zone, name) for zone in records for name, address in records[zone])
+        print >> sys.stderr, "%d name(s) changed, %d unchanged" % (
+            len(changed), len(names - changed))
+    if failed:
+        print >> sys.stderr, "ERROR: %d update(s) failed" % failed
+        sys.exit(1)
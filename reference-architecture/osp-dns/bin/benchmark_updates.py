@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# Measure the update throughput of add_a_record.py against the in process
+# dns_update_responder.py, without a BIND server
+#
+# Registers --records A records spread over --zones zones, one record per
+# UPDATE message and TCP connection (the single record path), then in batch
+# mode, then syncs the unchanged records again. Every path is checked
+# against the zone contents, the exit status is 1 when one failed.
+#
+
+from __future__ import print_function
+
+import base64
+import os,sys
+import time
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# python2-dns
+import dns.name
+import dns.rcode
+
+import add_a_record
+import dns_update_responder
+
+
+def make_records(count, zones):
+    """
+    Return a dictionary of zone to list of (name, address) pairs, as
+    add_a_record.read_records does.
+    """
+    records = OrderedDict(('zone%d.example.com' % i, []) for i in range(zones))
+    for i in range(count):
+        records['zone%d.example.com' % (i % zones)].append(
+            ('node%d' % i, '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255)))
+    return records
+
+
+def check_zones(responder, records):
+    """
+    Return the number of records missing from the zones of the responder.
+    """
+    missing = 0
+    for zone, zone_records in records.items():
+        origin = dns.name.from_text(zone)
+        for name, address in zone_records:
+            rdataset = responder.zones[origin].get_rdataset(
+                dns.name.from_text(name, origin), 'A')
+            if rdataset is None or address not in [r.address for r in rdataset]:
+                missing += 1
+    return missing
+
+
+def run(label, responder, records, function):
+    """
+    Run function, then print its throughput and the messages it cost.
+    Return True when every record was updated.
+    """
+    before = dict(responder.stats)
+    start = time.time()
+    failed = function()
+    elapsed = time.time() - start
+    cost = dict((key, responder.stats[key] - before[key]) for key in before)
+    count = sum(len(zone_records) for zone_records in records.values())
+    missing = check_zones(responder, records)
+    print("%-8s %6d records %8.3fs %10.1f records/s  %5d connections "
+          "%5d updates %5d queries %3d transfers%s" % (
+              label, count, elapsed, count / elapsed, cost['connections'],
+              cost['updates'], cost['queries'], cost['transfers'],
+              "  FAILED: %d failed, %d missing" % (failed, missing)
+              if failed or missing else ""))
+    return not failed and not missing
+
+
+if __name__ == "__main__":
+
+    def process_arguments():
+        parser = ArgumentParser()
+        parser.add_argument("-n", "--records", type=int, default=500)
+        parser.add_argument("-z", "--zones", type=int, default=1)
+        parser.add_argument("-b", "--batch-size", type=int, default=500)
+        parser.add_argument("-j", "--jobs", type=int, default=4)
+        parser.add_argument("--delay", type=float, default=0,
+                            help="milliseconds each response is held, see dns_update_responder.py")
+        return parser.parse_args()
+
+    opts = process_arguments()
+    key = base64.b64encode(os.urandom(16)).decode('ascii')
+    records = make_records(opts.records, opts.zones)
+    responder = dns_update_responder.UpdateResponder(
+        records.keys(), key, delay=opts.delay).start()
+    port = responder.address[1]
+
+    def single():
+        failed = 0
+        for zone, zone_records in records.items():
+            for name, address in zone_records:
+                r = add_a_record.add_a_record('127.0.0.1', zone, key, name,
+                                              address, 300, port)
+                failed += r.rcode() != dns.rcode.NOERROR
+        return failed
+
+    def batch(sync=None):
+        def update():
+            results = add_a_record.add_a_records_batch(
+                '127.0.0.1', key, records, 300, opts.batch_size, port,
+                jobs=opts.jobs, sync=sync)
+            return sum(rcode != dns.rcode.NOERROR
+                       for _, _, _, _, rcode in results)
+        return update
+
+    ok = run("single", responder, records, single)
+    responder.reset()
+    ok = run("batch", responder, records, batch()) and ok
+    ok = run("sync", responder, records, batch('auto')) and ok
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+#
+# Local RFC 2136 UPDATE responder for developing bin/add_a_record.py
+#
+# Serves zones from memory over TCP: TSIG signed UPDATE messages are
+# applied to them, AXFR and A queries are answered from them. Names containing
+# --refuse are REFUSED, to exercise the failure paths. --delay holds every
+# response for that many milliseconds, to stand in for the network round trip
+# to a real server. Counts connections, messages and applied changes,
+# printed on exit.
+#
+# bin/benchmark_updates.py runs it in process to measure add_a_record.py.
+#
+
+from __future__ import print_function
+
+import os
+import socket
+import struct
+import threading
+import time
+from argparse import ArgumentParser
+
+# python2-dns
+import dns.message
+import dns.name
+import dns.opcode
+import dns.rcode
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+import dns.tsigkeyring
+import dns.zone
+
+
+ZONE_TEMPLATE = """
+@ 3600 IN SOA ns1 hostmaster 1 3600 600 86400 300
+@ 3600 IN NS ns1
+ns1 3600 IN A 127.0.0.1
+"""
+
+
+class UpdateResponder(object):
+    """
+    In memory zones served over TCP, see the module comment.
+    """
+
+    def __init__(self, zones, key, host='127.0.0.1', port=0, refuse='refused',
+                 delay=0):
+        self.origins = [dns.name.from_text(zone) for zone in zones]
+        self.lock = threading.Lock()
+        self.reset()
+        self.keyring = dns.tsigkeyring.from_text({'update-key': key})
+        self.refuse = refuse
+        self.delay = delay
+        self.stats = {'connections': 0, 'updates': 0, 'queries': 0,
+                      'transfers': 0, 'changes': 0, 'refused': 0}
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(16)
+        self.address = self.sock.getsockname()
+
+    def reset(self):
+        """
+        Start again from empty zones, serial 1.
+        """
+        # absolute names, responses are written without an origin
+        zones = dict((origin, dns.zone.from_text(ZONE_TEMPLATE, origin,
+                                                 relativize=False))
+                     for origin in self.origins)
+        with self.lock:
+            self.zones = zones
+
+    def find_zone(self, name):
+        for origin in self.origins:
+            if name.is_subdomain(origin):
+                return self.zones[origin]
+        return None
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def serve_forever(self):
+        while True:
+            conn, _ = self.sock.accept()
+            with self.lock:
+                self.stats['connections'] += 1
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        try:
+            while True:
+                data = self.read(conn, 2)
+                if not data:
+                    break
+                (length,) = struct.unpack('!H', data)
+                query = dns.message.from_wire(self.read(conn, length),
+                                              keyring=self.keyring)
+                with self.lock:
+                    response = self.respond(query)
+                if self.delay:
+                    time.sleep(self.delay / 1000.0)
+                wire = response.to_wire(max_size=65535)
+                conn.sendall(struct.pack('!H', len(wire)) + wire)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def read(conn, count):
+        data = b''
+        while len(data) < count:
+            chunk = conn.recv(count - len(data))
+            if not chunk:
+                if data:
+                    raise EOFError
+                return data
+            data += chunk
+        return data
+
+    def respond(self, query):
+        response = dns.message.make_response(query)
+        if query.opcode() == dns.opcode.UPDATE:
+            self.stats['updates'] += 1
+            response.set_rcode(self.update(query))
+            return response
+
+        question = query.question[0]
+        zone = self.find_zone(question.name)
+        if zone is None:
+            response.set_rcode(dns.rcode.REFUSED)
+            return response
+
+        if question.rdtype == dns.rdatatype.AXFR:
+            self.stats['transfers'] += 1
+            if question.name != zone.origin:
+                response.set_rcode(dns.rcode.NOTAUTH)
+                return response
+            soa = zone.find_rrset(zone.origin, dns.rdatatype.SOA)
+            response.answer.append(soa)
+            for name, rdataset in zone.iterate_rdatasets():
+                if rdataset.rdtype != dns.rdatatype.SOA:
+                    response.answer.append(zone.find_rrset(name, rdataset.rdtype))
+            response.answer.append(soa)
+            return response
+
+        self.stats['queries'] += 1
+        rrset = zone.get_rrset(question.name, question.rdtype)
+        if rrset is not None:
+            response.answer.append(rrset)
+        return response
+
+    def update(self, query):
+        if not query.had_tsig:
+            return dns.rcode.REFUSED
+        zone = self.zones.get(query.question[0].name)
+        if zone is None:
+            return dns.rcode.NOTAUTH
+        # UPDATE messages are applied as a whole
+        for rrset in query.authority:
+            if self.refuse and self.refuse in rrset.name.to_text():
+                self.stats['refused'] += 1
+                return dns.rcode.REFUSED
+
+        for rrset in query.authority:
+            name = rrset.name
+            if rrset.deleting == dns.rdataclass.ANY:
+                if rrset.rdtype == dns.rdatatype.ANY:
+                    zone.delete_node(name)
+                else:
+                    zone.delete_rdataset(name, rrset.rdtype)
+            elif rrset.deleting == dns.rdataclass.NONE:
+                rdataset = zone.get_rdataset(name, rrset.rdtype)
+                if rdataset is not None:
+                    for rdata in rrset:
+                        rdataset.discard(rdata)
+                    if not rdataset:
+                        zone.delete_rdataset(name, rrset.rdtype)
+            else:
+                rdataset = zone.find_rdataset(name, rrset.rdtype, create=True)
+                rdataset.ttl = rrset.ttl
+                for rdata in rrset:
+                    rdataset.add(rdata)
+            self.stats['changes'] += len(rrset) or 1
+
+        soa = zone.find_rdataset(zone.origin, dns.rdatatype.SOA)
+        old = soa[0]
+        soa.clear()
+        soa.add(dns.rdata.from_text(
+            dns.rdataclass.IN, dns.rdatatype.SOA, '%s %s %d %d %d %d %d' % (
+                old.mname, old.rname, old.serial + 1, old.refresh, old.retry,
+                old.expire, old.minimum)))
+        return dns.rcode.NOERROR
+
+    def serial(self, zone):
+        origin = dns.name.from_text(zone)
+        return self.zones[origin].find_rdataset(origin, dns.rdatatype.SOA)[0].serial
+
+
+if __name__ == "__main__":
+
+    def process_arguments():
+        parser = ArgumentParser()
+        parser.add_argument("-z", "--zone", type=str, action="append",
+                            help="zone to serve, repeatable, example.com by default")
+        parser.add_argument("-k", "--key", type=str, default=os.getenv("DNS_KEY"))
+        parser.add_argument("-p", "--port", type=int, default=5353)
+        parser.add_argument("--refuse", type=str, default="refused")
+        parser.add_argument("--delay", type=float, default=0,
+                            help="milliseconds each response is held")
+        return parser.parse_args()
+
+    opts = process_arguments()
+    zones = opts.zone or ["example.com"]
+    responder = UpdateResponder(zones, opts.key, port=opts.port,
+                                refuse=opts.refuse, delay=opts.delay)
+    print("serving %s on %s:%d" % ((", ".join(zones),) + responder.address))
+    try:
+        responder.serve_forever()
+    except KeyboardInterrupt:
+        print(responder.stats)
+        for zone in zones:
+            print(zone, "serial", responder.serial(zone))
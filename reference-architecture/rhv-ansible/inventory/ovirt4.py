@@ -60,6 +60,7 @@ Author: Ondra Machacek (@machacekondra)
 """
 
 import argparse
+import hashlib
 import os
 import sys
 
@@ -79,10 +80,26 @@ try:
     import ovirtsdk4 as sdk
     import ovirtsdk4.types as otypes
 except ImportError:
-    print('oVirt inventory script requires ovirt-engine-sdk-python >= 4.0.0')
+    print('oVirt inventory script requires ovirt-engine-sdk-python >= 4.1.0')
     sys.exit(1)
 
 
+# Sub-resources of the vms which can be collected, see 'ovirt_resources':
+VM_RESOURCES = (
+    'devices',
+    'tags',
+    'statistics',
+    'affinity_labels',
+    'affinity_groups',
+)
+
+# CloudInventoryCache is shared by the inventory scripts of this repository,
+# from its inventory/lib directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', '..', '..', 'inventory', 'lib'))
+from cloud_inventory_cache import CloudInventoryCache
+
+
 def parse_args():
     """
     Create command line parser for oVirt dynamic inventory script.
@@ -106,12 +123,18 @@ def parse_args():
         default=False,
         help='Pretty format (default: False).',
     )
+    parser.add_argument(
+        '--refresh-cache',
+        action='store_true',
+        default=False,
+        help='Force refresh of cache by making API requests to oVirt (default: False - use cache files).',
+    )
     return parser.parse_args()
 
 
-def create_connection():
+def read_config():
     """
-    Create a connection to oVirt engine API.
+    Read the oVirt inventory configuration file.
     """
     # Get the path of the configuration file, by default use
     # 'ovirt.ini' file in script directory:
@@ -128,12 +151,65 @@ def create_connection():
             'ovirt_username': None,
             'ovirt_password': None,
             'ovirt_ca_file': None,
+            'ovirt_connections': '4',
+            'ovirt_batch_size': '100',
+            'ovirt_resources': ','.join(VM_RESOURCES),
+            'ovirt_cluster': '',
+            'ovirt_tag': '',
+            'ovirt_status': '',
+            'ovirt_search': '',
+            'ovirt_page_size': '0',
+            'cache_path': '~/.ansible/tmp',
+            'cache_max_age': '300',
+            'cache_compression': '',
         }
     )
     if not config.has_section('ovirt'):
         config.add_section('ovirt')
     config.read(config_path)
+    return config
+
 
+def get_resources(config):
+    """
+    Return the tuple of vm sub-resources configured to be collected, in the
+    order of `VM_RESOURCES`.
+    """
+    selected = set(
+        name.strip()
+        for name in config.get('ovirt', 'ovirt_resources').split(',')
+        if name.strip()
+    )
+    unknown = selected - set(VM_RESOURCES)
+    if unknown:
+        raise ValueError(
+            'Unknown ovirt_resources: %s, supported are: %s' % (
+                ', '.join(sorted(unknown)), ', '.join(VM_RESOURCES),
+            )
+        )
+    return tuple(name for name in VM_RESOURCES if name in selected)
+
+
+def get_search(config):
+    """
+    Return the engine search expression selecting the vms of the inventory,
+    built from the cluster, tag and status options and the free form
+    'ovirt_search' option, or None to select all vms.
+    """
+    terms = [
+        '%s=%s' % (name, config.get('ovirt', 'ovirt_%s' % name))
+        for name in ('cluster', 'tag', 'status')
+        if config.get('ovirt', 'ovirt_%s' % name)
+    ]
+    if config.get('ovirt', 'ovirt_search'):
+        terms.append(config.get('ovirt', 'ovirt_search'))
+    return ' and '.join(terms) or None
+
+
+def create_connection(config):
+    """
+    Create a connection to oVirt engine API.
+    """
     # Create a connection with options defined in ini file:
     return sdk.Connection(
         url=config.get('ovirt', 'ovirt_url'),
@@ -141,117 +217,319 @@ def create_connection():
         password=config.get('ovirt', 'ovirt_password'),
         ca_file=config.get('ovirt', 'ovirt_ca_file'),
         insecure=config.get('ovirt', 'ovirt_ca_file') is None,
+        connections=config.getint('ovirt', 'ovirt_connections'),
     )
 
 
-def get_dict_of_struct(connection, vm):
+def wait_all(results, pending):
     """
-    Transform SDK Vm Struct type to Python dictionary.
+    Wait for the `pending` (key, name, future) requests, store their
+    responses in `results` and empty `pending`.
     """
-    if vm is None:
-        return dict()
+    for key, name, future in pending:
+        results[key][name] = future.wait()
+    del pending[:]
+
 
+def fetch_vm_resources(connection, vms, batch_size=100, collect=VM_RESOURCES):
+    """
+    Fetch the reported devices, tags, statistics and affinity labels of
+    `vms` listed in `collect` with asynchronous requests, waiting for the
+    responses every `batch_size` requests. Every sub-resource is fetched
+    once per vm. Returns dictionary of vm id to dictionary of the fetched
+    lists.
+    """
     vms_service = connection.system_service().vms_service()
+    resources = dict((vm.id, dict()) for vm in vms)
+    pending = []
+    for vm in vms:
+        vm_service = vms_service.vm_service(vm.id)
+        for name, service in (
+            ('devices', vm_service.reported_devices_service),
+            ('tags', vm_service.tags_service),
+            ('statistics', vm_service.statistics_service),
+            ('affinity_labels', vm_service.affinity_labels_service),
+        ):
+            if name not in collect:
+                continue
+            pending.append((vm.id, name, service().list(wait=False)))
+            if len(pending) >= batch_size:
+                wait_all(resources, pending)
+    wait_all(resources, pending)
+    return resources
+
+
+def fetch_affinity_groups(connection, cluster_ids):
+    """
+    Fetch affinity groups of every cluster in `cluster_ids` with one
+    asynchronous request per cluster. Returns dictionary of cluster id to
+    list of affinity groups.
+    """
+    clusters_service = connection.system_service().clusters_service()
+    groups = dict((cluster_id, dict()) for cluster_id in cluster_ids)
+    pending = [
+        (
+            cluster_id,
+            'groups',
+            clusters_service.cluster_service(
+                cluster_id
+            ).affinity_groups_service().list(wait=False),
+        )
+        for cluster_id in groups
+    ]
+    wait_all(groups, pending)
+    return dict((key, value['groups']) for key, value in groups.items())
+
+
+def fetch_affinity_group_index(connection, cluster_ids):
+    """
+    Fetch affinity groups of every cluster in `cluster_ids` and the
+    members of each group once, with asynchronous requests, and invert
+    them into an index. Returns dictionary of vm id to list of names of
+    the affinity groups the vm is member of.
+    """
     clusters_service = connection.system_service().clusters_service()
-    vm_service = vms_service.vm_service(vm.id)
-    devices = vm_service.reported_devices_service().list()
-    tags = vm_service.tags_service().list()
-    stats = vm_service.statistics_service().list()
-    labels = vm_service.affinity_labels_service().list()
-    groups = clusters_service.cluster_service(
-        vm.cluster.id
-    ).affinity_groups_service().list()
-
-    return {
+    groups = fetch_affinity_groups(connection, cluster_ids)
+    members = dict()
+    pending = []
+    for cluster_id, cluster_groups in groups.items():
+        groups_service = clusters_service.cluster_service(
+            cluster_id
+        ).affinity_groups_service()
+        for group in cluster_groups:
+            members[group.id] = dict()
+            pending.append((
+                group.id,
+                'vms',
+                groups_service.group_service(group.id).vms_service().list(wait=False),
+            ))
+    wait_all(members, pending)
+
+    index = defaultdict(list)
+    for cluster_groups in groups.values():
+        for group in cluster_groups:
+            for member in members[group.id]['vms']:
+                index[member.id].append(group.name)
+    return index
+
+
+def fetch_names(connection):
+    """
+    List all clusters, hosts and templates once, with asynchronous
+    requests. Returns dictionary of 'clusters', 'hosts' and 'templates'
+    to dictionary of id to name.
+    """
+    system_service = connection.system_service()
+    names = dict(
+        (kind, dict()) for kind in ('clusters', 'hosts', 'templates')
+    )
+    pending = [
+        ('clusters', 'list', system_service.clusters_service().list(wait=False)),
+        ('hosts', 'list', system_service.hosts_service().list(wait=False)),
+        ('templates', 'list', system_service.templates_service().list(wait=False)),
+    ]
+    wait_all(names, pending)
+    return dict(
+        (kind, dict((obj.id, obj.name) for obj in value['list']))
+        for kind, value in names.items()
+    )
+
+
+def get_link_name(connection, link, names=None):
+    """
+    Return name of the object `link` points to, from the `names` map of
+    id to name when it is known there, otherwise by following the link.
+    """
+    if link is None:
+        return None
+    if names is not None and link.id in names:
+        return names[link.id]
+    return connection.follow_link(link).name
+
+
+def get_dict_of_struct(connection, vm, resources, affinity_groups, names,
+                       collect=VM_RESOURCES):
+    """
+    Transform SDK Vm Struct type to Python dictionary.
+
+    Only the sub-resources listed in `collect` are added, the list itself
+    is stored as 'collected_resources', so a missing key can be told from
+    an empty sub-resource. `resources` are the sub-resources of the vm as
+    returned by `fetch_vm_resources` and `affinity_groups` the names of the
+    affinity groups the vm is member of. `names` is the map returned by
+    `fetch_names`, cluster, host and template links missing from it are
+    followed.
+    """
+    data = {
         'id': vm.id,
         'name': vm.name,
-        'host': connection.follow_link(vm.host).name if vm.host else None,
-        'cluster': connection.follow_link(vm.cluster).name,
+        'host': get_link_name(connection, vm.host, names.get('hosts')),
+        'cluster': get_link_name(connection, vm.cluster, names.get('clusters')),
         'status': str(vm.status),
         'description': vm.description,
         'fqdn': vm.fqdn,
         'os_type': vm.os.type,
-        'template': connection.follow_link(vm.template).name,
-        'tags': [tag.name for tag in tags],
-        'affinity_labels': [label.name for label in labels],
-        'affinity_groups': [
-            group.name for group in groups
-            if vm.name in [vm.name for vm in connection.follow_link(group.vms)]
-        ],
-        'statistics': dict(
-            (stat.name, stat.values[0].datum) for stat in stats
-        ),
-        'devices': dict(
-            (device.name, [ip.address for ip in device.ips]) for device in devices if device.ips
-        ),
-        'ansible_host': next((device.ips[0].address for device in devices if device.ips and device.name == "eth0"), None)
+        'template': get_link_name(connection, vm.template, names.get('templates')),
+        'collected_resources': list(collect),
     }
+    if 'tags' in collect:
+        data['tags'] = [tag.name for tag in resources['tags']]
+    if 'affinity_labels' in collect:
+        data['affinity_labels'] = [label.name for label in resources['affinity_labels']]
+    if 'affinity_groups' in collect:
+        data['affinity_groups'] = list(affinity_groups)
+    if 'statistics' in collect:
+        data['statistics'] = dict(
+            (stat.name, stat.values[0].datum) for stat in resources['statistics']
+        )
+    if 'devices' in collect:
+        devices = resources['devices']
+        data['devices'] = dict(
+            (device.name, [ip.address for ip in device.ips]) for device in devices if device.ips
+        )
+        data['ansible_host'] = next((device.ips[0].address for device in devices if device.ips and device.name == "eth0"), None)
+    return data
 
 
-def get_data(connection, vm_name=None):
+def list_vms(connection, search=None, page_size=0):
     """
-    Obtain data of `vm_name` if specified, otherwise obtain data of all vms.
+    List the vms matching the `search` expression, all of them if None.
+    If `page_size` is positive the vms are listed in pages of `page_size`
+    vms sorted by name, until a page comes back short.
     """
     vms_service = connection.system_service().vms_service()
-    clusters_service = connection.system_service().clusters_service()
+    if page_size <= 0:
+        return vms_service.list(search=search)
+
+    vms = []
+    page = 1
+    while True:
+        batch = vms_service.list(
+            search='%s sortby name asc page %d' % (search or '', page),
+            max=page_size,
+        )
+        vms.extend(batch)
+        if len(batch) < page_size:
+            return vms
+        page += 1
 
-    if vm_name:
-        vm = vms_service.list(search='name=%s' % vm_name) or [None]
-        data = get_dict_of_struct(
-            connection=connection,
-            vm=vm[0],
+
+def get_data(connection, batch_size=100, collect=VM_RESOURCES, search=None,
+             page_size=0):
+    """
+    Obtain data of all vms matching the `search` expression, listed in
+    pages of `page_size` vms, with the sub-resources listed in `collect`.
+    """
+    vms = dict()
+    data = defaultdict(list)
+    all_vms = list_vms(connection, search, page_size)
+    resources = fetch_vm_resources(connection, all_vms, batch_size, collect)
+    affinity_groups = dict()
+    if 'affinity_groups' in collect:
+        affinity_groups = fetch_affinity_group_index(
+            connection, set(vm.cluster.id for vm in all_vms)
         )
-    else:
-        vms = dict()
-        data = defaultdict(list)
-        for vm in vms_service.list():
-            name = vm.name
-            vm_service = vms_service.vm_service(vm.id)
-            cluster_service = clusters_service.cluster_service(vm.cluster.id)
-
-            # Add vm to vms dict:
-            vms[name] = get_dict_of_struct(connection, vm)
-
-            # Add vm to cluster group:
-            cluster_name = connection.follow_link(vm.cluster).name
-            data['cluster_%s' % cluster_name].append(name)
-
-            # Add vm to tag group:
-            tags_service = vm_service.tags_service()
-            for tag in tags_service.list():
-                data['tag_%s' % tag.name].append(name)
-
-            # Add vm to status group:
-            data['status_%s' % vm.status].append(name)
-
-            # Add vm to affinity group:
-            for group in cluster_service.affinity_groups_service().list():
-                if vm.name in [
-                    v.name for v in connection.follow_link(group.vms)
-                ]:
-                    data['affinity_group_%s' % group.name].append(vm.name)
-
-            # Add vm to affinity label group:
-            affinity_labels_service = vm_service.affinity_labels_service()
-            for label in affinity_labels_service.list():
-                data['affinity_label_%s' % label.name].append(name)
-
-        data["_meta"] = {
-            'hostvars': vms,
-        }
+    names = fetch_names(connection)
+    for vm in all_vms:
+        name = vm.name
+
+        # Add vm to vms dict, the groups below reuse its data:
+        vms[name] = get_dict_of_struct(
+            connection,
+            vm,
+            resources=resources[vm.id],
+            affinity_groups=affinity_groups.get(vm.id, []),
+            names=names,
+            collect=collect,
+        )
+
+        # Add vm to cluster group:
+        data['cluster_%s' % vms[name]['cluster']].append(name)
 
+        # Add vm to tag group:
+        for tag in vms[name].get('tags', []):
+            data['tag_%s' % tag].append(name)
+
+        # Add vm to status group:
+        data['status_%s' % vm.status].append(name)
+
+        # Add vm to affinity group:
+        for group in vms[name].get('affinity_groups', []):
+            data['affinity_group_%s' % group].append(name)
+
+        # Add vm to affinity label group:
+        for label in vms[name].get('affinity_labels', []):
+            data['affinity_label_%s' % label].append(name)
+
+    data["_meta"] = {
+        'hostvars': vms,
+    }
+
+
+    return data
+
+
+def create_cache(config):
+    """
+    Create the cache of the full inventory. Caches are keyed by engine,
+    user, search expression and collected sub-resources, so inventories
+    configured differently never share a cache file.
+    """
+    cache_key = hashlib.sha1(('%s:%s:%s:%s' % (
+        config.get('ovirt', 'ovirt_url'),
+        config.get('ovirt', 'ovirt_username'),
+        get_search(config),
+        ','.join(get_resources(config)),
+    )).encode('utf-8')).hexdigest()[:12]
+    return CloudInventoryCache(
+        cache_name='ansible-ovirt-%s.cache' % cache_key,
+        cache_path=config.get('ovirt', 'cache_path'),
+        cache_max_age=config.getint('ovirt', 'cache_max_age'),
+        compression=config.get('ovirt', 'cache_compression'),
+    )
+
+
+def get_cached_data(config, vm_name=None, refresh=False):
+    """
+    Obtain data of `vm_name` if specified, otherwise obtain data of all vms,
+    from the cache of the full inventory while it is valid. The engine is
+    only connected on cache miss, or when `vm_name` is not in the cache, to
+    fetch and cache the full inventory again.
+    """
+    cache = create_cache(config)
+    data = None
+    if not refresh and cache.is_valid():
+        data = cache.get_all_data_from_cache()
+        if vm_name and vm_name not in data['_meta']['hostvars']:
+            data = None
+
+    if data is None:
+        data = get_data(
+            connection=create_connection(config),
+            batch_size=config.getint('ovirt', 'ovirt_batch_size'),
+            collect=get_resources(config),
+            search=get_search(config),
+            page_size=config.getint('ovirt', 'ovirt_page_size'),
+        )
+        # cache_max_age 0 disables the cache, it would never be read:
+        if cache.cache_max_age > 0:
+            cache.write_to_cache(data)
+
+    if vm_name:
+        return data['_meta']['hostvars'].get(vm_name, {})
     return data
 
 
 def main():
     args = parse_args()
-    connection = create_connection()
+    config = read_config()
 
     print(
         json.dumps(
-            obj=get_data(
-                connection=connection,
+            obj=get_cached_data(
+                config=config,
                 vm_name=args.host,
+                refresh=args.refresh_cache,
             ),
             sort_keys=args.pretty,
             indent=args.pretty * 2,
@@ -29,18 +29,21 @@ import datetime
 import getpass
 import jinja2
 import os
+import shutil
 import six
 import ssl
 import sys
+import tempfile
 import uuid
 
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 from six.moves import configparser
-from time import time
+from six.moves.urllib.parse import quote
 
 HAS_PYVMOMI = False
 try:
-    from pyVmomi import vim
+    from pyVmomi import vim, SoapStubAdapter
     from pyVim.connect import SmartConnect, Disconnect
     HAS_PYVMOMI = True
 except ImportError:
@@ -58,6 +61,15 @@ try:
 except ImportError:
     pass
 
+# Version 2 of the cache index names the directory of its host records
+CACHE_SCHEMA_VERSION = 2
+
+# CloudInventoryCache is shared by the inventory scripts of this repository,
+# from its inventory/lib directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', '..', '..', '..', '..', 'inventory', 'lib'))
+from cloud_inventory_cache import CloudInventoryCache
+
 
 class VMWareInventory(object):
 
@@ -79,6 +91,11 @@ class VMWareInventory(object):
     password = None
     host_filters = []
     groupby_patterns = []
+    properties = []
+    vcenters = []
+    session_cache = False
+    lazy_hostvars = False
+    indexes = []
 
     bad_types = ['Array', 'disabledMethod', 'declaredAlarmState']
     if (sys.version_info > (3, 0)):
@@ -101,14 +118,27 @@ class VMWareInventory(object):
             self.parse_cli_args()
             self.read_settings()
 
-            # Check the cache
-            cache_valid = self.is_cache_valid()
-
-            # Handle Cache
-            if self.args.refresh_cache or not cache_valid:
-                self.do_api_calls_update_cache()
+            # With every cache valid only the group indexes are loaded, host
+            # records are read on demand by get_host_info and write
+            if not self.args.refresh_cache and \
+                    all(self.is_cache_valid(x['cache']) for x in self.vcenters):
+                self.indexes = [(x, self.get_index_from_cache(x['cache'])) for x in self.vcenters]
+                self.inventory = self.merge_inventories(
+                    [(x, index['groups']) for x, index in self.indexes])
+                self.lazy_hostvars = True
+                return
+
+            # Query every vcenter concurrently, each against its own cache
+            if len(self.vcenters) > 1:
+                pool = ThreadPool(len(self.vcenters))
+                try:
+                    inventories = pool.map(self.get_vcenter_inventory, self.vcenters)
+                finally:
+                    pool.close()
             else:
-                self.inventory = self.get_inventory_from_cache()
+                inventories = [self.get_vcenter_inventory(x) for x in self.vcenters]
+
+            self.inventory = self.merge_inventories(list(zip(self.vcenters, inventories)))
 
     def debugl(self, text):
         if self.args.debug:
@@ -125,51 +155,178 @@ class VMWareInventory(object):
             data_to_print = self.get_host_info(self.args.host)
         elif self.args.list:
             # Display list of instances for inventory
+            if self.lazy_hostvars:
+                self.load_hostvars()
             data_to_print = self.inventory
         return json.dumps(data_to_print, indent=2)
 
+    def write(self, out):
 
-    def is_cache_valid(self):
+        ''' Write the output to out, streaming cached host records for --list '''
 
-        ''' Determines if the cache files have expired, or if it is still valid '''
+        if self.args.host or not self.lazy_hostvars:
+            out.write(self.show() + '\n')
+            return
+
+        out.write('{\n')
+        for group, data in self.inventory.items():
+            if group == '_meta':
+                continue
+            out.write('  %s: %s,\n' % (json.dumps(group), json.dumps(data)))
+        out.write('  "_meta": {"hostvars": {')
+        sep = '\n'
+        for vcenter, index in self.indexes:
+            cache = vcenter['cache']
+            records_path = self._records_path(cache, index)
+            for host in index['groups'].get('all', {}).get('hosts', []):
+                record = cache.get_raw_data_from_cache(self._record_file(records_path, host))
+                out.write('%s    %s: %s' % (sep, json.dumps(host), record))
+                sep = ',\n'
+        out.write('\n  }}\n}\n')
 
-        valid = False
 
-        if os.path.isfile(self.cache_path_cache):
-            mod_time = os.path.getmtime(self.cache_path_cache)
-            current_time = time()
-            if (mod_time + self.cache_max_age) > current_time:
-                valid = True
+    def is_cache_valid(self, cache):
+
+        ''' Determines if the cache files have expired, or if it is still valid '''
 
-        return valid
+        return cache.is_valid()
 
 
-    def do_api_calls_update_cache(self):
+    def do_api_calls_update_cache(self, vcenter=None):
 
         ''' Get instances and cache the data '''
 
-        instances = self.get_instances()
+        vcenter = vcenter or self.vcenters[0]
+        instances = self.get_instances(vcenter)
         self.instances = instances
-        self.inventory = self.instances_to_inventory(instances)
-        self.write_to_cache(self.inventory, self.cache_path_cache)
+        inventory = self.instances_to_inventory(instances)
+        self.write_to_cache(inventory, vcenter['cache'])
+        return inventory
+
+
+    def get_vcenter_inventory(self, vcenter):
+
+        ''' Return the inventory of one vcenter, from its cache when still valid '''
+
+        if not self.args.refresh_cache and \
+                self.is_cache_valid(vcenter['cache']):
+            return self.get_inventory_from_cache(vcenter['cache'])
+        return self.do_api_calls_update_cache(vcenter)
+
+
+    def merge_inventories(self, inventories):
+
+        ''' Merge (vcenter, inventory) pairs, prefixing group names per vcenter '''
+
+        inventory = self._empty_inventory()
+        inventory['all'] = {}
+        inventory['all']['hosts'] = []
+        for vcenter, vinventory in inventories:
+            prefix = vcenter['group_prefix']
+            for k, v in vinventory.items():
+                if k == '_meta':
+                    inventory['_meta']['hostvars'].update(v['hostvars'])
+                    continue
+                if k == 'all':
+                    inventory['all']['hosts'] += v['hosts']
+                    if prefix:
+                        inventory[prefix] = {'hosts': list(v['hosts'])}
+                    continue
+                if prefix:
+                    k = '%s_%s' % (prefix, k)
+                if k not in inventory:
+                    inventory[k] = {}
+                    inventory[k]['hosts'] = []
+                inventory[k]['hosts'] += v['hosts']
+        return inventory
+
+
+    def _records_path(self, cache, index):
+
+        ''' Directory of the hostvars records named by a group index '''
+
+        return os.path.join(os.path.dirname(cache.cache_path_cache), index['records'])
+
+
+    def _record_file(self, records_path, host):
+        # quote() only takes bytes with non-ASCII characters on python 2
+        if not isinstance(host, bytes):
+            host = host.encode('utf-8')
+        return os.path.join(records_path, quote(host, safe='') + '.json')
+
+
+    def write_to_cache(self, data, cache):
+
+        ''' Dump inventory to a json group index plus one json record per host
+
+        Every write goes to a new records directory, named in the index that
+        is renamed over the old one. Readers holding the previous index keep
+        reading its directory, which is only removed by the next write. '''
+
+        cache_dir = os.path.dirname(cache.cache_path_cache)
+        prefix = os.path.basename(cache.cache_path_cache) + '.d.'
+        # writers are serialized, so the directory of the previous index is
+        # never removed by a concurrent write
+        cache.acquire_lock()
+        try:
+            records_path = tempfile.mkdtemp(dir=cache_dir, prefix=prefix)
+            for host, hostvars in data['_meta']['hostvars'].items():
+                cache.write_to_cache(hostvars, self._record_file(records_path, host))
+
+            keep = [os.path.basename(records_path)]
+            try:
+                keep.append(cache.get_all_data_from_cache()['records'])
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+            # the index is written last, its mtime marks the cache as valid
+            index = dict((k, v) for k, v in data.items() if k != '_meta')
+            cache.write_to_cache({'records': keep[0], 'groups': index})
+            for name in os.listdir(cache_dir):
+                if name.startswith(prefix) and name not in keep:
+                    shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+        finally:
+            cache.release_lock()
+
 
+    def get_index_from_cache(self, cache):
 
-    def write_to_cache(self, data, cache_path):
+        ''' Read in the jsonified group index and the name of its records
+        directory, without hostvars '''
 
-        ''' Dump inventory to json file '''
+        return cache.get_all_data_from_cache()
 
-        with open(self.cache_path_cache, 'wb') as f:
-            f.write(json.dumps(data))
 
+    def get_host_from_cache(self, host, cache, index):
 
-    def get_inventory_from_cache(self):
+        ''' Read in the jsonified record of one host, None if it is not cached '''
+
+        record = self._record_file(self._records_path(cache, index), host)
+        if not os.path.isfile(record):
+            return None
+        return cache.get_all_data_from_cache(record)
+
+
+    def get_inventory_from_cache(self, cache):
 
         ''' Read in jsonified inventory '''
 
-        jdata = None
-        with open(self.cache_path_cache, 'rb') as f:
-            jdata = f.read()
-        return json.loads(jdata)
+        index = self.get_index_from_cache(cache)
+        inventory = index['groups']
+        inventory['_meta'] = {'hostvars': {}}
+        for host in inventory.get('all', {}).get('hosts', []):
+            inventory['_meta']['hostvars'][host] = self.get_host_from_cache(host, cache, index)
+        return inventory
+
+
+    def load_hostvars(self):
+
+        ''' Read every cached host record into the inventory '''
+
+        for vcenter, index in self.indexes:
+            for host in index['groups'].get('all', {}).get('hosts', []):
+                self.inventory['_meta']['hostvars'][host] = \
+                    self.get_host_from_cache(host, vcenter['cache'], index)
+        self.lazy_hostvars = False
 
 
     def read_settings(self):
@@ -194,6 +351,10 @@ class VMWareInventory(object):
                         'host_pattern': '{{ guest.ipaddress }}',
                         'host_filters': '{{ guest.gueststate == "running" }}',
                         'groupby_patterns': '{{ guest.guestid }},{{ "templates" if config.template else "guests"}}',
+                        'properties': '',
+                        'servers': '',
+                        'session_cache': False,
+                        'cache_compression': '',
                         'lower_var_keys': True }
            }
 
@@ -219,8 +380,14 @@ class VMWareInventory(object):
 
         # set the cache filename and max age
         cache_name = config.get('vmware', 'cache_name')
-        self.cache_path_cache = self.cache_dir + "/%s.cache" % cache_name
         self.cache_max_age = int(config.getint('vmware', 'cache_max_age'))
+        cache_compression = config.get('vmware', 'cache_compression')
+        cache = CloudInventoryCache(cache_name="%s.cache" % cache_name,
+                                    cache_path=self.cache_dir,
+                                    cache_max_age=self.cache_max_age,
+                                    compression=cache_compression,
+                                    schema_version=CACHE_SCHEMA_VERSION)
+        self.cache_path_cache = cache.cache_path_cache
 
         # mark the connection info 
         self.server =  os.environ.get('VMWARE_SERVER', config.get('vmware', 'server'))
@@ -240,6 +407,46 @@ class VMWareInventory(object):
         self.host_filters = list(config.get('vmware', 'host_filters').split(','))
         self.groupby_patterns = list(config.get('vmware', 'groupby_patterns').split(','))
 
+        # property paths to fetch server side, empty means walk everything
+        self.properties = [x.strip() for x in config.get('vmware', 'properties').split(',')
+                           if x.strip()]
+
+        self.session_cache = str(config.get('vmware', 'session_cache')).lower() in ['yes', 'true', '1']
+
+        # one vcenter per section listed in servers, or the [vmware] one
+        self.vcenters = []
+        servers = [x.strip() for x in config.get('vmware', 'servers').split(',') if x.strip()]
+        for name in servers:
+            def _get(key, name=name):
+                if config.has_option(name, key):
+                    return config.get(name, key)
+                return config.get('vmware', key)
+            self.vcenters.append({
+                'name': name,
+                'server': _get('server'),
+                'port': int(_get('port')),
+                'username': _get('username'),
+                'password': _get('password'),
+                'cache': CloudInventoryCache(cache_name="%s_%s.cache" % (cache_name, name),
+                                             cache_path=self.cache_dir,
+                                             cache_max_age=int(_get('cache_max_age')),
+                                             compression=cache_compression,
+                                             schema_version=CACHE_SCHEMA_VERSION),
+                'session_path': self.cache_dir + "/%s_%s.session" % (cache_name, name),
+                'group_prefix': config.get(name, 'group_prefix') if config.has_option(name, 'group_prefix') else name,
+            })
+        if not self.vcenters:
+            self.vcenters.append({
+                'name': self.server,
+                'server': self.server,
+                'port': self.port,
+                'username': self.username,
+                'password': self.password,
+                'cache': cache,
+                'session_path': self.cache_dir + "/%s.session" % cache_name,
+                'group_prefix': '',
+            })
+
         # save the config
         self.config = config    
 
@@ -262,16 +469,17 @@ class VMWareInventory(object):
         self.args = parser.parse_args()
 
 
-    def get_instances(self):
+    def get_instances(self, vcenter=None):
 
         ''' Get a list of vm instances with pyvmomi '''
 
         instances = []        
+        vcenter = vcenter or self.vcenters[0]
 
-        kwargs = {'host': self.server,
-                      'user': self.username,
-                      'pwd': self.password,
-                      'port': int(self.port) }
+        kwargs = {'host': vcenter['server'],
+                      'user': vcenter['username'],
+                      'pwd': vcenter['password'],
+                      'port': int(vcenter['port']) }
 
         if hasattr(ssl, 'SSLContext'):
             # older ssl libs do not have an SSLContext method:
@@ -283,50 +491,155 @@ class VMWareInventory(object):
             context.verify_mode = ssl.CERT_NONE
             kwargs['sslContext'] = context
 
-        instances = self._get_instances(kwargs)
+        session_path = vcenter['session_path'] if self.session_cache else None
+        instances = self._get_instances(kwargs, session_path=session_path)
         self.debugl("### INSTANCES RETRIEVED")
         return instances
 
 
-    def _get_instances(self, inkwargs):
+    def _resume_session(self, inkwargs, session_path):
+
+        ''' Rebuild a service instance from a cached session cookie, None if it expired '''
+
+        if not os.path.isfile(session_path):
+            return None
+        try:
+            with open(session_path, 'r') as f:
+                session = json.loads(f.read())
+            stub = SoapStubAdapter(host=inkwargs['host'], port=inkwargs['port'],
+                                   version=session['version'],
+                                   sslContext=inkwargs.get('sslContext'))
+            stub.cookie = session['cookie']
+            si = vim.ServiceInstance('ServiceInstance', stub)
+            if si.content.sessionManager.currentSession is None:
+                return None
+        except Exception as e:
+            self.debugl("SESSION CACHE MISS: %s" % e)
+            return None
+        self.debugl("SESSION CACHE HIT: %s" % session_path)
+        return si
+
+
+    def _save_session(self, si, session_path):
+
+        ''' Store the session cookie readable by the current user only '''
+
+        data = json.dumps({'cookie': si._stub.cookie, 'version': si._stub.version})
+        fd = os.open(session_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+
+
+    def _connect(self, inkwargs, session_path=None):
+
+        ''' Log in, reusing a cached session when session_path is given '''
+
+        if session_path:
+            si = self._resume_session(inkwargs, session_path)
+            if si:
+                return si
+
+        si = SmartConnect(**inkwargs)
+        if not si:
+            return si
+
+        if session_path:
+            # keep the session alive for the next run instead of logging out
+            self._save_session(si, session_path)
+        else:
+            atexit.register(Disconnect, si)
+        return si
+
+
+    def _get_instances(self, inkwargs, session_path=None):
 
         ''' Make API calls '''
 
         instances = []
-        si = SmartConnect(**inkwargs)
+        si = self._connect(inkwargs, session_path=session_path)
             
         if not si:
             print("Could not connect to the specified host using specified "
                 "username and password")
             return -1
-        atexit.register(Disconnect, si)
         content = si.RetrieveContent()
+        limit = self.args.max_instances or None
+        if self.properties:
+            return self._get_instances_with_properties(content, limit=limit)
         for child in content.rootFolder.childEntity:
-            instances += self._get_instances_from_children(child)
-        if self.args.max_instances:
-            if len(instances) >= (self.args.max_instances+1):
-                instances = instances[0:(self.args.max_instances+1)]
+            remaining = None if limit is None else limit - len(instances)
+            if remaining is not None and remaining <= 0:
+                break
+            instances += self._get_instances_from_children(child, limit=remaining)
         instance_tuples = []    
-        for instance in sorted(instances):    
+        # the walk is already ordered, avoid comparing managed objects again
+        for instance in instances:    
             ifacts = self.facts_from_vobj(instance)
             instance_tuples.append((instance, ifacts))
         return instance_tuples
 
 
-    def _get_instances_from_children(self, child):
+    def _get_instances_with_properties(self, content, limit=None):
+
+        ''' Fetch only the configured property paths for every VM with the property collector '''
+
+        view = content.viewManager.CreateContainerView(content.rootFolder,
+                                                       [vim.VirtualMachine], True)
+        traversal = vim.PropertyCollector.TraversalSpec(name='traverseEntities',
+                                                        path='view', skip=False,
+                                                        type=vim.view.ContainerView)
+        obj_spec = vim.PropertyCollector.ObjectSpec(obj=view, skip=True,
+                                                    selectSet=[traversal])
+        prop_spec = vim.PropertyCollector.PropertySpec(type=vim.VirtualMachine,
+                                                       pathSet=self.properties)
+        filter_spec = vim.PropertyCollector.FilterSpec(objectSet=[obj_spec],
+                                                       propSet=[prop_spec])
+
+        collector = content.propertyCollector
+        instance_tuples = []
+        options = vim.PropertyCollector.RetrieveOptions()
+        if limit is not None:
+            options.maxObjects = limit
+        result = collector.RetrievePropertiesEx([filter_spec], options)
+        while result:
+            for oc in result.objects:
+                if limit is not None and len(instance_tuples) >= limit:
+                    break
+                self.debugl("GUEST: %s" % oc.obj)
+                instance_tuples.append((oc.obj, self.facts_from_proplist(oc.propSet)))
+            if not result.token:
+                break
+            if limit is not None and len(instance_tuples) >= limit:
+                collector.CancelRetrievePropertiesEx(result.token)
+                break
+            result = collector.ContinueRetrievePropertiesEx(result.token)
+        view.Destroy()
+        return instance_tuples
+
+
+    def _get_instances_from_children(self, child, limit=None):
+
+        ''' Walk the folder tree, stopping once limit instances are found '''
+
         instances = []
+        if limit is not None and limit <= 0:
+            return instances
 
         if hasattr(child, 'childEntity'):
             self.debugl("CHILDREN: %s" % child.childEntity)
-            instances += self._get_instances_from_children(child.childEntity)
+            instances += self._get_instances_from_children(child.childEntity, limit=limit)
         elif hasattr(child, 'vmFolder'):
             self.debugl("FOLDER: %s" % child)
-            instances += self._get_instances_from_children(child.vmFolder)
+            instances += self._get_instances_from_children(child.vmFolder, limit=limit)
         elif hasattr(child, 'index'):
             self.debugl("LIST: %s" % child)
             for x in sorted(child):
+                remaining = None if limit is None else limit - len(instances)
+                if remaining is not None and remaining <= 0:
+                    break
                 self.debugl("LIST_ITEM: %s" % x)
-                instances += self._get_instances_from_children(x)
+                instances += self._get_instances_from_children(x, limit=remaining)
         elif hasattr(child, 'guest'):
             self.debugl("GUEST: %s" % child)
             instances.append(child)
@@ -334,7 +647,7 @@ class VMWareInventory(object):
             # resource pools
             self.debugl("RESOURCEPOOL: %s" % child.vm)
             if child.vm:
-                instances += self._get_instances_from_children(child.vm)
+                instances += self._get_instances_from_children(child.vm, limit=limit)
         else:            
             self.debugl("ELSE ...")
             try:
@@ -520,6 +833,24 @@ class VMWareInventory(object):
         return rdata
 
 
+    def facts_from_proplist(self, proplist):
+
+        ''' Build a nested fact dict from property collector (path, value) pairs '''
+
+        rdata = {}
+        for prop in proplist:
+            path = prop.name.split('.')
+            if self.lowerkeys:
+                path = [x.lower() for x in path]
+            node = rdata
+            for key in path[:-1]:
+                if not isinstance(node.get(key), dict):
+                    node[key] = {}
+                node = node[key]
+            node[path[-1]] = self._process_object_types(prop.val)
+        return rdata
+
+
     def _process_object_types(self, vobj, level=0):
 
         rdata = {}
@@ -564,9 +895,16 @@ class VMWareInventory(object):
         
         ''' Return hostvars for a single host '''
 
-        return self.inventory['_meta']['hostvars'][host]
+        if not self.lazy_hostvars:
+            return self.inventory['_meta']['hostvars'][host]
+
+        for vcenter, index in self.indexes:
+            hostvars = self.get_host_from_cache(host, vcenter['cache'], index)
+            if hostvars is not None:
+                return hostvars
+        return {}
 
 
 if __name__ == "__main__":
     # Run the script
-    print(VMWareInventory().show())
+    VMWareInventory().write(sys.stdout)
@@ -0,0 +1,63 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: expandtab:tabstop=4:shiftwidth=4
+'''
+Custom filters for use by the static_inventory role
+'''
+
+
+def classify_servers(servers, stack_name, private_network='private',
+                     provider_network=None, old_app_nodes=None):
+    ''' Classifies the OpenStack servers of the stack_name cluster in a
+    single pass. Returns a dictionary of:
+     - nodes: the servers of the cluster
+     - bastion_nodes: the servers of the infra.<stack_name> group
+     - floating_nodes: the servers of the cluster with a floating IP, or
+       without one when a provider network is used
+     - new_app_nodes: the app nodes of the cluster missing from
+       old_app_nodes, when old_app_nodes is not empty
+     - old_nodes: the nodes which are not new_app_nodes
+     - private_v4: server name to its first address on private_network
+    '''
+    result = {
+        'nodes': [],
+        'bastion_nodes': [],
+        'floating_nodes': [],
+        'new_app_nodes': [],
+        'old_nodes': [],
+        'private_v4': {},
+    }
+    old_app_nodes = set(old_app_nodes or [])
+
+    for server in servers:
+        metadata = server.get('metadata') or {}
+        if metadata.get('group') == 'infra.%s' % stack_name:
+            result['bastion_nodes'].append(server)
+        if metadata.get('clusterid') != stack_name:
+            continue
+
+        result['nodes'].append(server)
+        has_floating_ip = server.get('public_v4') != ''
+        if has_floating_ip != bool(provider_network):
+            result['floating_nodes'].append(server)
+        is_new = old_app_nodes and server['name'] not in old_app_nodes
+        if is_new and metadata.get('sub-host-type') == 'app':
+            result['new_app_nodes'].append(server)
+        else:
+            result['old_nodes'].append(server)
+
+        addresses = (server.get('addresses') or {}).get(private_network)
+        if addresses:
+            result['private_v4'][server['name']] = addresses[0]['addr']
+
+    return result
+
+
+class FilterModule(object):
+    ''' Custom ansible filters for use by the static_inventory role'''
+
+    def filters(self):
+        ''' returns a mapping of filters to methods '''
+        return {
+            "classify_servers": classify_servers,
+        }